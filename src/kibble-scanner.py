@@ -18,7 +18,7 @@
 import os
 import sys
 import threading
-import multiprocessing
+import signal
 import yaml
 import json
 import time
@@ -26,12 +26,16 @@ import re
 import argparse
 import plugins.scanners
 import plugins.brokers.kibbleES
-#import plugins.kibbleJSON
+import plugins.brokers.kibbleJSON
+import plugins.utils.workqueue
+import plugins.utils.processpool
+import plugins.utils.concurrency
+import plugins.utils.asyncengine
+import plugins.utils.balance
+import plugins.utils.planner
 
 VERSION = "0.2.0"
 CONFIG_FILE = "../conf/config.yaml"
-PENDING_OBJECTS = []
-BIG_LOCK = threading.Lock()
 
 def base_parser():
     arg_parser = argparse.ArgumentParser()
@@ -43,6 +47,11 @@ def base_parser():
     arg_parser.add_argument("-t", "--type", help="Specific type of scanner to run (default is run all scanners)")
     arg_parser.add_argument("-e", "--exclude", nargs = '+', help="Specific type of scanner(s) to exclude")
     arg_parser.add_argument("-v", "--view", help="Specific source view to scan (default is scan all sources)")
+    arg_parser.add_argument("-w", "--workers-mode", choices = ['thread', 'process'], default = 'thread', help="Whether to run CPU-bound scanners (git-census, git-evolution, pipermail) in the scanner threads or in a pool of worker processes (default is thread)")
+    arg_parser.add_argument("-d", "--daemon", action = 'store_true', help="Keep running, re-scanning each source once its interval (scanner.intervals, per source type) has passed")
+    arg_parser.add_argument("-u", "--upload", action = 'store_true', help="Upload the documents in the spool (elasticsearch.spool) to ElasticSearch, then exit. With --daemon, keep uploading new ones as they come in")
+    arg_parser.add_argument("-r", "--replay", nargs = '?', const = '', metavar = 'FILE', help="Push the documents in a bulk dead letter file (default is the elasticsearch.bulk.deadletter setting) to the database again, then exit")
+    arg_parser.add_argument("-p", "--plan", "--dry-run", action = 'store_true', help="Only print the list of sources and scanners this node would run, then exit")
     arg_parser.add_argument("-j", "--filter", nargs='+', help="Jenkins-only: Filter the list of jobs (e.g. for debugging). To drill down to the target jobs, all nodes to the leaf node(s) are required, e.g --filter <project> <jobgroup> <targetjob1> <targetjob2>. Type is set to jenkins implicitely.")
     return arg_parser
 
@@ -54,75 +63,170 @@ def pprint(string, err = False):
         print(line)
 
 
-def isMine(ID, config):
-    if config['scanner'].get('balance',  None):
-        a = config['scanner']['balance'].split('/')
-        nodeNo = int(a[0])
-        numNodes = int(a[1])
-        if numNodes == 0:
-            return True
-        bignum = int(ID, 16) % numNodes
-        if bignum == int(nodeNo)-1:
-            return True
-        return False
-    return True
-
 class scanThread(threading.Thread):
-    """ A thread object that grabs an item from the queue and processes
-        it, using whatever plugins will come out to play. """
-    def __init__(self, broker, org, i, t = None, e = None, f= None):
+    """ A thread object that grabs work from the queue and processes it.
+        Work is either a whole task, planned by the planner, or a single
+        step (scanner) of a task that has become runnable. """
+    def __init__(self, broker, queue, i, pool = None, leases = None):
         super(scanThread, self).__init__()
         self.broker = broker
-        self.org = org
+        self.queue = queue
+        self.pool = pool
+        self.leases = leases # Scan leases, if we steal work
         self.id = i
-        self.bit = self.broker.bitClass(self.broker, self.org, i)
-        self.stype = t
-        self.exclude = e
-        self.filter = f
-        # override
-        if self.filter:
-            self.stype = "jenkins"
+        self.bits = {} # One KibbleBit per organisation we've worked on
         pprint("Initialized thread %i" % i)
 
+    def getBit(self, org):
+        """ Fetches (or sets up) the KibbleBit for an organisation """
+        if org.id not in self.bits:
+            self.bits[org.id] = self.broker.bitClass(self.broker, org, self.id)
+        return self.bits[org.id]
+
     def run(self):
-        global BIG_LOCK, PENDING_OBJECTS
         time.sleep(0.5) # Primarily to align printouts.
-        # While there are objects to snag
-        a = 0
-        while PENDING_OBJECTS:
-            BIG_LOCK.acquire(blocking = True)
+        # While there is work to snag, grab some. The queue blocks
+        # until work shows up and hands us None once it has run dry.
+        # Sources are still being listed as we start, so which type of
+        # work we favour is worked out as we go.
+        while True:
+            job = self.queue.get(self.queue.preferred(self.id - 1))
+            if job is None:
+                break
+            task, step = job[1]
             try:
-                # Try grabbing an object (might not be any left!)
-                obj = PENDING_OBJECTS.pop(0)
-                #print("object: %s" %(obj))
-            except:
-                pass
-            BIG_LOCK.release()
-            if obj:
-                # If load balancing jobs, make sure this one is ours
-                if isMine(obj['sourceID'], self.broker.config):
-                    # Run through list of scanners in order, apply when useful
-                    for sid, scanner in plugins.scanners.enumerate():
-
-                        if scanner.accepts(obj):
-                            self.bit.pluginname = "plugins/scanners/" + sid
-                            # Excluded scanner type?
-                            if self.exclude and sid in self.exclude:
-                                continue
-                            # specific jenkins filter
-                            if self.stype and self.stype == sid and self.filter and sid == "jenkins":
-                                scanner.scan(self.bit, obj, self.filter)
-                            # Specific scanner type or no types mentioned?
-                            elif not self.stype or self.stype == sid:
-                                scanner.scan(self.bit, obj)
+                if step:
+                    self.runStep(self.getBit(task.org), task, step)
+                else:
+                    self.startTask(self.getBit(task.org), task)
+            finally:
+                # Any follow-up steps have been queued by now, so the
+                # queue won't think we're all out of work.
+                self.queue.done(job[0])
+        for bit in self.bits.values():
+            bit.pluginname = "core"
+            bit.pprint("No more objects, exiting!")
+
+    def startTask(self, bit, task):
+        """ Starts a task, taking the lease on its source first if need be.
+            The first runnable step is run right away, the others are
+            queued up for whichever worker is free. """
+        obj = task.source
+        # If nodes steal work from each other, we need the lease on
+        # the source, whether it is ours or not. It is renewed in the
+        # background for as long as the scan takes.
+        if self.leases:
+            if not self.leases.acquire(obj['sourceID'], task.planned):
+                bit.pluginname = "core"
+                bit.pprint("%s is being (or has been) scanned by another node, skipping" % obj['sourceURL'])
+                task.finished.set()
+                return
+        # Status updates from here on only need to carry what changed
+        self.broker.trackSource(obj)
+        self.queueSteps(task, task.roots[1:])
+        self.runStep(bit, task, task.roots[0])
+
+    def queueSteps(self, task, steps):
+        """ Queues up steps of a task for whichever worker is free. When
+            we're shutting down, the queue drops them, and they count as
+            not run. Returns whether that was the end of the task. """
+        last = False
+        for step in steps:
+            if not self.queue.put(task.source['type'], (task, step), task.org.id, task.priority):
+                last = task.finish(step[0], False)[2] or last
+        return last
+
+    def runStep(self, bit, task, step):
+        """ Runs a single scanner on a task's source, then queues up
+            the steps that were waiting for it """
+        obj = task.source
+        sid, scanner, args = step
+        bit.pluginname = "plugins/scanners/" + sid
+        good = False
+        started = time.time()
+        try:
+            # Plugins with an async entry point run on the async engine
+            if hasattr(scanner, 'scan_async'):
+                plugins.utils.asyncengine.run(scanner.scan_async(bit, obj, *args))
+            # CPU-heavy scanners go to the process pool, if we have one
+            elif self.pool and getattr(scanner, 'cpubound', False):
+                self.pool.scan(sid, bit, obj, *args)
             else:
-                break
-        self.bit.pluginname = "core"
-        self.bit.pprint("No more objects, exiting!")
+                scanner.scan(bit, obj, *args)
+            good = True
+            # Remember how long this took, for scheduling the next run
+            obj.setdefault('durations', {})[sid] = round(time.time() - started, 1)
+        except Exception as e:
+            bit.pprint("Scanning %s failed: %s" % (obj['sourceURL'], e), err = True)
+            bit.traceBack()
+        finally:
+            # Make sure the documents are in before anything that
+            # depends on this step gets to look for them.
+            bit.bulk()
+            ready, skipped, last = task.finish(sid, good)
+            for s in skipped:
+                bit.pprint("Skipping %s on %s, as %s failed" % (s[0], obj['sourceURL'], sid))
+            if self.queueSteps(task, ready):
+                last = True
+            if last:
+                bit.pluginname = "core"
+                bit.updateSource(obj, final = True)
+                if self.leases:
+                    self.leases.release(obj['sourceID'])
+
+def enqueue(queue, task):
+    """ Hands a planned task to the workers """
+    queue.put(task.source['type'], (task, None), task.org.id, task.priority)
+
+def daemon(broker, config, args, queue, intervals, running, stop):
+    """ Keeps looking for sources that are due for a re-scan, and feeds
+        them to the workers, until stop is set (by a SIGTERM or SIGINT).
+        Sources that are still queued or being scanned are left alone. """
+    poll = int(config['scanner'].get('poll', 300))
+    try:
+        while not stop.wait(poll):
+            try:
+                dispatch(broker, config, args, queue, intervals, running, stop)
+            except Exception as err:
+                # ES may be down for a bit, we'll try again next time
+                pprint("Could not plan the next round of scans: %s" % err, err = True)
+    finally:
+        # Pending work is dropped; it'll get planned again on the next start.
+        # Whatever is being scanned right now gets to finish.
+        queue.close(discard = True)
+
+def dispatch(broker, config, args, queue, intervals, running, stop):
+    """ Queues up the sources that are due for a scan, in one poll round """
+    for sid in [sid for sid, task in running.items() if task.finished.is_set()]:
+        del running[sid]
+    stealable = []
+    queued = 0
+    for batch in plugins.utils.planner.batches(plugins.utils.planner.plan(broker, config, org = args.org, view = args.view,
+                                               source = args.source, stype = args.type, exclude = args.exclude,
+                                               jfilter = args.filter, intervals = intervals)):
+        if stop.is_set():
+            return
+        for task in batch:
+            if task.source['sourceID'] in running:
+                continue
+            if task.mine:
+                enqueue(queue, task)
+                running[task.source['sourceID']] = task
+                queued += 1
+            else:
+                stealable.append(task)
+    # Only steal from other nodes when we have nothing else to do
+    if stealable and not len(queue):
+        for task in stealable:
+            enqueue(queue, task)
+            running[task.source['sourceID']] = task
+            queued += 1
+    if queued:
+        pprint("Queued %u sources that are due for a scan, %u sources in progress." % (queued, len(running)))
 
 def main():
     pprint("Kibble Scanner v/%s starting" % VERSION)
-    global CONFIG_FILE, PENDING_OBJECTS
+    global CONFIG_FILE
     args = base_parser().parse_args()
 
     # Load config yaml
@@ -130,6 +234,7 @@ def main():
         CONFIG_FILE = args.config
     config = yaml.load(open(CONFIG_FILE), Loader=yaml.Loader)
     pprint("Loaded YAML config from %s" % CONFIG_FILE)
+    plugins.utils.concurrency.configure(config)
 
     # Which broker type do we use here?
     broker = None
@@ -140,51 +245,139 @@ def main():
         pprint("Using HTTP JSON broker model")
         broker = plugins.brokers.kibbleJSON.Broker(config)
 
-    orgNo = 0
+    if args.upload:
+        stop = threading.Event()
+        def terminate(signum, frame):
+            stop.set()
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, terminate)
+        try:
+            pprint("Uploaded %u documents from the spool" % broker.upload(follow = args.daemon, stop = stop))
+        except ValueError as err:
+            pprint(err, err = True)
+            sys.exit(-1)
+        broker.close()
+        return
+
+    if args.replay is not None:
+        pprint("Replayed %u documents from the dead letter file" % broker.replay(args.replay or None))
+        broker.close()
+        return
+
+    # Work out what needs doing: which sources, and which scanners
+    # to run on each of them. As a daemon, sources get re-scanned once
+    # their interval has passed, so only the ones that are due count.
+    intervals = plugins.utils.planner.intervals(config, args.age) if args.daemon else None
+    tasks = plugins.utils.planner.plan(broker, config, org = args.org, view = args.view,
+                                       age = None if args.daemon else args.age, source = args.source,
+                                       stype = args.type, exclude = args.exclude, jfilter = args.filter,
+                                       intervals = intervals)
+    if args.plan:
+        taskNo = 0
+        for task in sorted(tasks, key = lambda task: task.priority, reverse = True):
+            taskNo += 1
+            pprint("Plan: %s" % task)
+        pprint("%u sources would be scanned by this node." % taskNo)
+        return
+
+    # All organisations share one pool of workers, and the most urgent
+    # of the sources waiting in the queue (see plugins/utils/planner.py)
+    # get scanned first. To keep one large organisation from starving
+    # the rest, we cap how many workers may be busy with any single
+    # organisation at a time.
+    queue = plugins.utils.workqueue.WorkQueue(int(plugins.utils.concurrency.CONFIG.get('organisation', 0)))
+
+    # On a SIGTERM or SIGINT, we stop handing out work, drop what is
+    # still queued and let the running scans finish.
+    stop = threading.Event()
+    def shutdown():
+        pprint("Shutting down, waiting for running scans to finish")
+        queue.close(discard = True)
+    def terminate(signum, frame):
+        if stop.is_set():
+            return
+        stop.set()
+        # We may have interrupted something that holds the queue's lock
+        # (or is printing), so leave the rest to another thread.
+        threading.Thread(target = shutdown).start()
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    # Start up the configured number of threads (scanner.concurrency.workers).
+    # In process mode, the CPU-bound work is farmed out to worker
+    # processes, so we need at least a thread per process to keep them fed.
+    threads = []
+    pool = None
+    core_count = plugins.utils.concurrency.workers()
+    if args.workers_mode == 'process':
+        processes = plugins.utils.concurrency.processes()
+        pprint("Running CPU-bound scanners in %u worker processes" % processes)
+        pool = plugins.utils.processpool.ProcessPool(broker, processes)
+        core_count = max(core_count, processes)
+    # Each thread favours a source type, and steals from the rest when
+    # idle. They start right away, and get to work as soon as the first
+    # organisation has been listed.
+    leases = plugins.utils.balance.Leases(broker, config) if plugins.utils.balance.stealing(config) else None
+    for i in range(0, core_count):
+        sThread = scanThread(broker, queue, i+1, pool, leases)
+        sThread.start()
+        threads.append(sThread)
+
+    # Sources are handed to the workers an organisation at a time, as
+    # they are listed, longest first (see plugins/utils/planner.py).
+    # When stealing work, other nodes' sources are held back until we've
+    # run out of our own.
+    stealable = []
+    running = {} # Tasks handed to the workers, by source ID
+    orgs = set()
     sourceNo = 0
-    for org in broker.organisations():
-        if not args.org or args.org == org.id:
-            pprint("Processing organisation %s" % org.id)
-            orgNo += 1
-
-            # Compile source list
-            # If --age is passed, only append source that either
-            # have never been scanned, or have been scanned more than
-            # N hours ago by any scanner.
-            if args.age:
-                minAge = time.time() - int(args.age) * 3600
-                for source in org.sources(view=args.view):
-                    tooNew = False
-                    if 'steps' in source:
-                        for key, step in source['steps'].items():
-                            if 'time' in step and step['time'] >= minAge:
-                                tooNew = True
-                                break
-                    if not tooNew:
-                        if not args.source or (args.source == source['sourceID']):
-                            PENDING_OBJECTS.append(source)
-            else:
-                PENDING_OBJECTS = []
-                for source in org.sources(view=args.view):
-                    #pprint("Checkng source %s" % source)
-                    if not args.source or (args.source == source['sourceID']) or (args.source == source['sourceURL']):
-                        PENDING_OBJECTS.append(source)
-                sourceNo += len(PENDING_OBJECTS)
-
-            # Start up some threads equal to number of cores on the box,
-            # but no more than 4. We don't want an IOWait nightmare.
-            threads = []
-            core_count = min((4, int( multiprocessing.cpu_count() )))
-            for i in range(0, core_count):
-                sThread = scanThread(broker, org, i+1, args.type, args.exclude, args.filter)
-                sThread.start()
-                threads.append(sThread)
-
-            # Wait for them all to finish.
-            for t in threads:
-                t.join()
-
-    pprint("All done scanning for now, found %i organisations and %i sources to process." % (orgNo, sourceNo))
+    try:
+        for batch in plugins.utils.planner.batches(tasks):
+            if stop.is_set():
+                break
+            for task in batch:
+                if task.mine:
+                    enqueue(queue, task)
+                    running[task.source['sourceID']] = task
+                else:
+                    stealable.append(task)
+                orgs.add(task.org.id)
+                sourceNo += 1
+    except BaseException:
+        # Don't leave the workers waiting for more
+        queue.close(discard = True)
+        raise
+
+    # Once our own sources have all been handed out, offer the idle
+    # workers whatever the other nodes haven't gotten to yet.
+    if stealable and not stop.is_set():
+        queue.waitEmpty()
+        if not stop.is_set():
+            pprint("Out of sources of our own, trying to steal %u sources from other nodes" % len(stealable))
+            for task in stealable:
+                enqueue(queue, task)
+                running[task.source['sourceID']] = task
+
+    if args.daemon:
+        pprint("Running as a daemon, checking for sources that are due every %u seconds" % int(config['scanner'].get('poll', 300)))
+        daemon(broker, config, args, queue, intervals, running, stop)
+    else:
+        # Steps get queued as the ones they depend on finish, so we can't
+        # close the queue until every worker is idle.
+        queue.waitIdle()
+        queue.close()
+
+    # Wait for them all to finish.
+    for t in threads:
+        t.join()
+    if pool:
+        pool.shutdown()
+    if leases:
+        leases.close()
+    plugins.utils.asyncengine.shutdown()
+    broker.close()
+
+    pprint("All done scanning for now, found %i organisations and %i sources to process." % (len(orgs), sourceNo))
 
 if __name__ == '__main__':
     main()
@@ -18,12 +18,88 @@
 import json
 import elasticsearch
 import elasticsearch.helpers
+import collections
+import concurrent.futures
+import copy
+import glob
+import gzip
+import os
+import queue
+import random
+import shutil
 import threading
 import sys
+import time
 import traceback
+import plugins.utils.concurrency
+import plugins.utils.idcache
 
 KIBBLE_DB_VERSION = 2  # Current DB struct version
 ACCEPTED_DB_VERSIONS = [1,2]  # Versions we know how to work with.
+PAGE_SIZE = 1000 # Hits per page when streaming search results
+MGET_SIZE = 1000 # Document IDs per multi-get request
+KEEP_ALIVE = '5m' # How long a point in time (or scroll) is kept open between pages
+PIT_VERSION = (7, 12) # First ES version that pages through a point in time with a tiebreaker
+STATUS_DELAY = 10 # Seconds to hold back source status updates, so they can be coalesced
+REQUEST_TIMEOUT = 30 # Default seconds before an ES request times out
+
+# Bulk item statuses that are worth retrying: ES is overloaded or not
+# reachable right now. Anything else is a bad document. N/A is what
+# older clients give us on connection errors.
+TRANSIENT_STATUS = (429, 502, 503, 504, 'N/A')
+
+# Painless script for KibbleBit.increment(): adds params.counts to a
+# document, unless an increment with the same marker already has.
+INCREMENT_SCRIPT = ("if (ctx._source.increments == null) { ctx._source.increments = []; } "
+                    "if (ctx._source.increments.contains(params.marker)) { ctx.op = 'noop'; } else { "
+                    "for (def field : params.counts.keySet()) { "
+                    "ctx._source[field] = (ctx._source[field] == null ? 0 : ctx._source[field]) + params.counts[field]; } "
+                    "ctx._source.increments.add(params.marker); }")
+
+# Errors ES (or the client) throws at us for APIs it doesn't have,
+# across the various client versions.
+ES_ERRORS = tuple(getattr(elasticsearch, e) for e in ('TransportError', 'ApiError') if hasattr(elasticsearch, e))
+
+def iterate(ES, index, body, size = PAGE_SIZE, **kwargs):
+    """ Streams all the hits of a search, one page at a time, so result
+        sets of any size can be walked in constant memory. Uses a point
+        in time and search_after on ES 7.12 and up, and a scroll on
+        anything older. Any sorting in the body is kept. """
+    pit = None
+    # Paging with search_after needs a unique sort. ES adds a tiebreaker
+    # (_shard_doc) to point in time searches from 7.12 on; before that,
+    # hits with the same sort values could be skipped or repeated.
+    try:
+        if tuple(int(n) for n in ES.info()['version']['number'].split('.')[:2]) >= PIT_VERSION:
+            pit = ES.open_point_in_time(index = index, keep_alive = KEEP_ALIVE)['id']
+    except (AttributeError, TypeError, ValueError) + ES_ERRORS:
+        pass
+    if not pit:
+        for hit in elasticsearch.helpers.scan(ES, index = index, query = body, size = size,
+                                              scroll = KEEP_ALIVE, preserve_order = 'sort' in body, **kwargs):
+            yield hit
+        return
+    try:
+        after = None
+        while True:
+            page = dict(body)
+            page['size'] = size
+            page['pit'] = {'id': pit, 'keep_alive': KEEP_ALIVE}
+            if after:
+                page['search_after'] = after
+            res = ES.search(body = page)
+            pit = res.get('pit_id', pit)
+            hits = res['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < size:
+                break
+            after = hits[-1]['sort']
+    finally:
+        try:
+            ES.close_point_in_time(body = {'id': pit})
+        except ES_ERRORS:
+            pass
 
 
 class _KibbleESWrapper(object):
@@ -39,10 +115,12 @@ class _KibbleESWrapper(object):
         return self.ES.get(index = index+'_'+doc_type, doc_type = '_doc', id = id)
     def exists(self, index, doc_type, id):
         return self.ES.exists(index = index+'_'+doc_type, doc_type = '_doc', id = id)
+    def mget(self, index, doc_type, body):
+        return self.ES.mget(index = index+'_'+doc_type, doc_type = '_doc', body = body)
     def delete(self, index, doc_type, id):
         return self.ES.delete(index = index+'_'+doc_type, doc_type = '_doc', id = id)
-    def index(self, index, doc_type, id, body):
-        return self.ES.index(index = index+'_'+doc_type, doc_type = '_doc', id = id, body = body)
+    def index(self, index, doc_type, id, body, **kwargs):
+        return self.ES.index(index = index+'_'+doc_type, doc_type = '_doc', id = id, body = body, **kwargs)
     def update(self, index, doc_type, id, body):
         return self.ES.update(index = index+'_'+doc_type, doc_type = '_doc', id = id, body = body)
     def search(self, index, doc_type, size = 100, body = None):
@@ -58,6 +136,8 @@ class _KibbleESWrapper(object):
             doc_type = '_doc',
             body = body
             )
+    def iterate(self, index, doc_type, body, size = PAGE_SIZE):
+        return iterate(self.ES, index+'_'+doc_type, body, size, doc_type = '_doc')
 
     class indicesClass(object):
         """ Indices helper class """
@@ -84,10 +164,12 @@ class _KibbleESWrapperSeven(object):
         return self.ES.get(index = index+'_'+doc_type, id = id)
     def exists(self, index, doc_type, id):
         return self.ES.exists(index = index+'_'+doc_type, id = id)
+    def mget(self, index, doc_type, body):
+        return self.ES.mget(index = index+'_'+doc_type, body = body)
     def delete(self, index, doc_type, id):
         return self.ES.delete(index = index+'_'+doc_type, id = id)
-    def index(self, index, doc_type, id, body):
-        return self.ES.index(index = index+'_'+doc_type, id = id, body = body)
+    def index(self, index, doc_type, id, body, **kwargs):
+        return self.ES.index(index = index+'_'+doc_type, id = id, body = body, **kwargs)
     def update(self, index, doc_type, id, body):
         return self.ES.update(index = index+'_'+doc_type, id = id, body = body)
     def search(self, index, doc_type, size = 100, body = None):
@@ -101,6 +183,8 @@ class _KibbleESWrapperSeven(object):
             index = index+'_'+doc_type,
             body = body
             )
+    def iterate(self, index, doc_type, body, size = PAGE_SIZE):
+        return iterate(self.ES, index+'_'+doc_type, body, size)
 
     class indicesClass(object):
         """ Indices helper class """
@@ -113,6 +197,39 @@ class _KibbleESWrapperSeven(object):
 
 
 
+def clientOptions(config, parallel):
+    """ Returns the connection pool options for the ES client, from the
+        elasticsearch.pool section of the config. Unless told otherwise,
+        the pool is sized so that every scan thread (and every plugin
+        sub-thread, and the bulk writer) can have a connection of its own,
+        instead of queueing up for one. The option names changed in the
+        8.x client, so we speak whichever dialect we have. """
+    pconfig = config['elasticsearch'].get('pool') or {}
+    cconfig = plugins.utils.concurrency.CONFIG
+    threads = plugins.utils.concurrency.workers() * int(cconfig.get('threads', plugins.utils.concurrency.DEFAULT_THREADS))
+    maxsize = int(pconfig.get('maxsize', threads + parallel + 2))
+    timeout = float(pconfig.get('timeout', REQUEST_TIMEOUT))
+    sniff = pconfig.get('sniff', False)
+    options = {
+        'max_retries': 5,
+        'retry_on_timeout': True,
+        'http_compress': bool(pconfig.get('compress', False)),
+        'sniff_on_start': bool(sniff),
+    }
+    if elasticsearch.VERSION[0] >= 8:
+        options['connections_per_node'] = maxsize
+        options['request_timeout'] = timeout
+        options['sniff_on_node_failure'] = bool(sniff)
+        if sniff:
+            options['min_delay_between_sniffing'] = float(pconfig.get('sniffinterval', 60))
+    else:
+        options['maxsize'] = maxsize
+        options['timeout'] = timeout
+        options['sniff_on_connection_fail'] = bool(sniff)
+        if sniff:
+            options['sniffer_timeout'] = float(pconfig.get('sniffinterval', 60))
+    return options
+
 # This is redundant, refactor later?
 def pprint(string, err = False):
     line = "[core]: %s" % (string)
@@ -121,6 +238,314 @@ def pprint(string, err = False):
     else:
         print(line)
 
+class BulkWriter:
+    """ Background bulk writer, one per broker (and thus per process).
+        KibbleBits hand it documents through a bounded queue, which
+        blocks them if ES can't keep up. The writer thread batches them
+        up and pushes a batch once it is full or has waited for long
+        enough, with a few bulk requests in flight at a time, so the
+        scanners can keep scanning while we index.
+
+        A batch is full when it hits either the document limit or the
+        target request size in bytes. The target size is tuned as we go
+        (additive increase, multiplicative decrease): it grows while ES
+        answers quickly, and is cut back when requests get slow or ES
+        starts rejecting them with a 429. """
+
+    def __init__(self, ES, config, section = 'elasticsearch'):
+        bconfig = config[section].get('bulk') or {}
+        self.ES = ES
+        self.batchSize = int(bconfig.get('size', 5000)) # Max documents per bulk request
+        self.maxBytes = int(bconfig.get('bytes', 10 * 1024 * 1024)) # Max bytes per bulk request
+        self.minBytes = min(self.maxBytes, 512 * 1024)
+        self.target = self.maxBytes // 2 # Current target request size, in bytes
+        self.latency = float(bconfig.get('latency', 2)) # Bulk requests slower than this (in seconds) make us back off
+        self.retries = int(bconfig.get('retries', 5)) # Attempts at items ES can't take right now
+        self.backoff = float(bconfig.get('backoff', 2)) # Seconds to wait before the first retry, doubling after that
+        self.maxBackoff = float(bconfig.get('maxbackoff', 120))
+        self.deadLetterFile = bconfig.get('deadletter', os.path.join(config.get('scanner', {}).get('scratchdir', '/tmp'), 'kibble-deadletter.json'))
+        self.stats = collections.Counter()
+        self.interval = float(bconfig.get('interval', 5)) # Max seconds a document waits for its batch to fill up
+        self.parallel = int(bconfig.get('parallel', 2)) # Bulk requests in flight at once
+        self.queue = queue.Queue(int(bconfig.get('queue', 10000)))
+        self.slots = threading.BoundedSemaphore(self.parallel)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pool = None
+        self.onFailed = None # Gets the actions that were dead lettered, if set
+
+    def start(self):
+        """ Starts the writer thread, if it isn't running yet """
+        with self.lock:
+            if not self.thread:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = self.parallel)
+                self.thread = threading.Thread(target = self.run, name = "bulkwriter", daemon = True)
+                self.thread.start()
+
+    def put(self, action):
+        """ Queues up a bulk action, blocking while the queue is full """
+        self.start()
+        # Size it up here, in the scanner's thread, rather than in the writer
+        size = len(json.dumps(action, default = str)) + 1
+        self.queue.put((size, action))
+
+    def flush(self):
+        """ Waits until everything queued so far has been pushed to ES """
+        if self.thread:
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+
+    def close(self):
+        """ Pushes whatever is left and stops the writer thread """
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.pool.shutdown(wait = True)
+            self.thread = None
+
+    def run(self):
+        batch = []
+        batchBytes = 0
+        deadline = None
+        while True:
+            try:
+                item = self.queue.get(timeout = max(0, deadline - time.time()) if batch else None)
+            except queue.Empty:
+                # Batch has waited long enough, push what we have
+                self.send(batch)
+                batch = []
+                batchBytes = 0
+                continue
+            if item is None or isinstance(item, threading.Event):
+                self.send(batch)
+                batch = []
+                batchBytes = 0
+                self.wait()
+                if item is None:
+                    return
+                item.set()
+                continue
+            size, action = item
+            # Would this one push us over the target size? Send what we have first.
+            if batch and batchBytes + size > self.target:
+                self.send(batch)
+                batch = []
+                batchBytes = 0
+            if not batch:
+                deadline = time.time() + self.interval
+            batch.append(action)
+            batchBytes += size
+            if len(batch) >= self.batchSize or batchBytes >= self.target:
+                self.send(batch)
+                batch = []
+                batchBytes = 0
+
+    def send(self, batch):
+        """ Hands a batch to the pool, once a request slot is free """
+        if not batch:
+            return
+        self.slots.acquire()
+        future = self.pool.submit(self.push, batch)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.sent)
+
+    def sent(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def wait(self):
+        """ Waits for all bulk requests in flight to finish """
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending)
+
+    def push(self, batch):
+        """ Pushes a batch of actions to ES. Items ES couldn't take right
+            now are retried with exponential backoff; items it won't ever
+            take go to the dead letter file. """
+        attempt = 0
+        while batch:
+            start = time.time()
+            try:
+                retry, failed = self.request(batch)
+            except Exception as err:
+                # Connection trouble or a timeout, the whole lot is worth another go
+                retry = batch
+                failed = []
+                pprint("Warning: Could not bulk insert %u documents: %s" % (len(batch), err))
+            took = time.time() - start
+            self.tune(took, bool(retry))
+            self.count('indexed', len(batch) - len(retry) - len(failed))
+            print("Result (success,failed): ", (len(batch) - len(retry) - len(failed), len(retry) + len(failed)))
+            if failed:
+                self.deadLetter(failed)
+            if retry:
+                attempt += 1
+                if attempt > self.retries:
+                    self.deadLetter([(action, {'status': 'gave up', 'error': "No luck after %u retries" % self.retries}) for action in retry])
+                    break
+                self.count('retried', len(retry))
+                backoff = min(self.maxBackoff, self.backoff * 2 ** (attempt - 1))
+                pprint("%u documents were not taken by ES, retrying in %u seconds" % (len(retry), backoff))
+                time.sleep(backoff * random.uniform(0.5, 1))
+            batch = retry
+
+    def request(self, batch):
+        """ Sends a single bulk request. Returns the list of actions that
+            are worth retrying, and a list of (action, result) for the
+            ones that failed for good. """
+        retry = []
+        failed = []
+        results = elasticsearch.helpers.streaming_bulk(self.ES, batch, chunk_size = len(batch),
+                                                       max_chunk_bytes = 2**31, raise_on_error = False,
+                                                       raise_on_exception = False)
+        for action, (ok, item) in zip(batch, list(results)):
+            if ok:
+                continue
+            result = list(item.values())[0]
+            if result.get('status') in TRANSIENT_STATUS:
+                retry.append(action)
+            else:
+                failed.append((action, result))
+        return retry, failed
+
+    def deadLetter(self, failed):
+        """ Writes actions ES won't take to the dead letter file, one JSON
+            object per line, so they can be replayed with --replay later. """
+        self.count('failed', len(failed))
+        error = failed[0][1].get('error')
+        pprint("Warning: %u documents could not be indexed, see %s. First error: %s" % (len(failed), self.deadLetterFile, error))
+        with self.lock:
+            with open(self.deadLetterFile, "a") as f:
+                for action, result in failed:
+                    f.write(json.dumps({
+                        'time': time.time(),
+                        'status': result.get('status'),
+                        'error': result.get('error'),
+                        'action': action
+                    }, default = str) + "\n")
+        if self.onFailed:
+            self.onFailed([action for action, result in failed])
+
+    def count(self, what, n):
+        with self.lock:
+            self.stats[what] += n
+
+    def summary(self):
+        """ Returns a one-line summary of what the writer has done so far """
+        with self.lock:
+            return "%u documents indexed, %u retries, %u failed" % (self.stats['indexed'], self.stats['retried'], self.stats['failed'])
+
+    def tune(self, took, rejected):
+        """ Adjusts the target request size after a bulk request """
+        with self.lock:
+            if rejected:
+                self.target = max(self.minBytes, self.target // 2)
+            elif took > self.latency:
+                self.target = max(self.minBytes, int(self.target * 0.75))
+            else:
+                self.target = min(self.maxBytes, self.target + self.maxBytes // 20)
+
+class SpoolWriter(BulkWriter):
+    """ Bulk writer that writes to a local spool instead of ES: a write
+        ahead log of gzipped NDJSON segment files, one bulk action per
+        line. Segments are rotated once they get big or old enough, and
+        `kibble-scanner.py --upload` drains finished ones into ES at its
+        own pace. Scanners thus never wait for ES to take their documents,
+        and nothing is lost while ES is down for maintenance. """
+
+    def __init__(self, ES, config):
+        BulkWriter.__init__(self, ES, config)
+        sconfig = config['elasticsearch']['spool']
+        self.spoolDir = sconfig['dir']
+        self.segmentBytes = int(sconfig.get('segment', 64 * 1024 * 1024)) # Max bytes (uncompressed) per segment
+        self.segmentAge = float(sconfig.get('age', 300)) # Max seconds a segment is kept open
+        self.segment = None # Path of the open segment
+        self.segmentFile = None
+        self.segmentStart = 0
+        self.segmentSize = 0
+        self.spoolLock = threading.Lock()
+        os.makedirs(self.spoolDir, exist_ok = True)
+
+    def request(self, batch):
+        data = "".join(json.dumps(action, default = str) + "\n" for action in batch).encode('utf-8')
+        with self.spoolLock:
+            if self.segmentFile and (self.segmentSize >= self.segmentBytes or time.time() - self.segmentStart >= self.segmentAge):
+                self.rotate()
+            if not self.segmentFile:
+                # Open segments end in .part, and sort by creation time
+                self.segment = os.path.join(self.spoolDir, "%019u-%u.ndjson.gz.part" % (time.time_ns(), os.getpid()))
+                self.segmentFile = open(self.segment, "wb")
+                self.segmentStart = time.time()
+                self.segmentSize = 0
+            # Every batch is a gzip member of its own, and is flushed to
+            # disk straight away, so a crash only ever loses the last one.
+            self.segmentFile.write(gzip.compress(data, compresslevel = 5))
+            self.segmentFile.flush()
+            os.fsync(self.segmentFile.fileno())
+            self.segmentSize += len(data)
+        return [], []
+
+    def rotate(self):
+        """ Closes the open segment and hands it to the uploader. Must
+            be called with spoolLock held. """
+        if self.segmentFile:
+            self.segmentFile.close()
+            os.rename(self.segment, self.segment[:-len(".part")])
+            self.segmentFile = None
+            self.segment = None
+
+    def flush(self):
+        BulkWriter.flush(self)
+        # Don't sit on an old segment just because nothing new comes in
+        with self.spoolLock:
+            if self.segmentFile and time.time() - self.segmentStart >= self.segmentAge:
+                self.rotate()
+
+    def close(self):
+        BulkWriter.close(self)
+        with self.spoolLock:
+            self.rotate()
+
+    def summary(self):
+        with self.lock:
+            return "%u documents spooled to %s" % (self.stats['indexed'], self.spoolDir)
+
+def segments(spoolDir):
+    """ Returns the spool segments that are ready to upload, oldest
+        first. Open segments left behind by processes that are gone
+        count as finished. """
+    ready = []
+    for path in glob.glob(os.path.join(spoolDir, "*.ndjson.gz*")):
+        if path.endswith(".part"):
+            pid = int(os.path.basename(path).split('-')[1].split('.')[0])
+            try:
+                os.kill(pid, 0)
+                continue # Still being written to
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+        ready.append(path)
+    return sorted(ready, key = os.path.basename)
+
+def readSegment(path):
+    """ Yields the bulk actions in a spool segment. A segment cut short
+        by a crash is read up to where it breaks off. """
+    try:
+        with gzip.open(path, "rt", encoding = 'utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    break
+    except (EOFError, gzip.BadGzipFile, OSError) as err:
+        pprint("Warning: spool segment %s is damaged, using what could be read: %s" % (path, err))
+
 class KibbleBit:
     """ KibbleBit class with direct ElasticSearch access """
 
@@ -128,17 +553,10 @@ class KibbleBit:
         self.config = broker.config
         self.organisation = organisation
         self.broker = broker
-        self.json_queue = []
-        self.queueMax = 1000 # Entries to keep before bulk pushing
         self.pluginname = ""
         self.tid = tid
         self.dbname = self.broker.config['elasticsearch']['database']
-
-    def __del__(self):
-        """ On unload/delete, push the last chunks of data to ES """
-        if self.json_queue:
-            print("Pushing stragglers")
-            self.bulk()
+        self.idcache = broker.idCache(organisation.id) # Known document IDs, if enabled
 
     def pprint(self,  string, err = False):
         line = "[thread#%i:%s]: %s" % (self.tid, self.pluginname, string)
@@ -147,29 +565,109 @@ class KibbleBit:
         else:
             print(line)
 
-    def updateSource(self, source):
-        """ Updates a source document, usually with a status update """
-        self.broker.DB.index(index=self.broker.config['elasticsearch']['database'],
-            doc_type="source",
-            id=source['sourceID'],
-            body = source
-        )
+    def updateSource(self, source, final = False):
+        """ Updates a source document, usually with a status update.
+            Only the fields (and steps) that changed are sent, as a
+            partial update through the bulk writer, and updates that
+            come in quick succession are coalesced into one. Pass
+            final = True to send it off right away. """
+        self.broker.updateSource(source, final)
 
     def get(self, doctype, docid):
         """ Fetches a document from the DB """
         doc = self.broker.DB.get(index=self.broker.config['elasticsearch']['database'], doc_type=doctype, id = docid)
         if doc:
+            if self.idcache:
+                self.idcache.add(doctype, [docid])
             return doc['_source']
         return None
 
+    def search(self, doctype, body, size = 100):
+        """ Runs a search on a document type, returns the raw ES response """
+        return self.broker.DB.search(index = self.dbname, doc_type = doctype, body = body, size = size)
+
     def exists(self, doctype, docid):
         """ Checks whether a document already exists or not """
-        return self.broker.DB.exists(index=self.broker.config['elasticsearch']['database'], doc_type=doctype, id = docid)
+        if self.idcache:
+            self.warm(doctype)
+            if self.idcache.has(doctype, docid):
+                return True
+        found = self.broker.DB.exists(index=self.broker.config['elasticsearch']['database'], doc_type=doctype, id = docid)
+        if found and self.idcache:
+            self.idcache.add(doctype, [docid])
+        return found
+
+    def warm(self, doctype):
+        """ Fills the ID cache with all the IDs of a doctype in this
+            organisation, if we haven't done so lately. One scroll over
+            the IDs beats looking them up one by one. """
+        if self.idcache.isWarm(doctype):
+            return
+        with self.idcache.warmLock:
+            if self.idcache.isWarm(doctype):
+                return
+            n = 0
+            docids = []
+            for hit in self.broker.iterate(doctype, {
+                    'query': {
+                        'term': {
+                            'organisation': self.organisation.id
+                        }
+                    },
+                    '_source': False,
+                    'sort': ['_doc']
+                }):
+                docids.append(hit['_id'])
+                n += 1
+                if len(docids) >= MGET_SIZE:
+                    self.idcache.add(doctype, docids)
+                    docids = []
+            self.idcache.add(doctype, docids)
+            self.idcache.warmed(doctype)
+            self.pprint("Loaded %u known %s IDs into the ID cache" % (n, doctype))
+
+    def mget(self, doctype, ids, source = True):
+        """ Looks up documents in batches of MGET_SIZE, yielding
+            (id, document) for every one that exists. source is passed
+            on as _source: True, False or a list of fields to fetch. """
+        dbname = self.broker.config['elasticsearch']['database']
+        ids = list(dict.fromkeys(ids)) # Drop duplicates, keep the order
+        for i in range(0, len(ids), MGET_SIZE):
+            res = self.broker.DB.mget(index=dbname, doc_type=doctype, body = {
+                'docs': [{'_id': docid, '_source': source} for docid in ids[i:i+MGET_SIZE]]
+            })
+            for doc in res['docs']:
+                if doc.get('found'):
+                    yield doc['_id'], doc.get('_source')
+
+    def get_many(self, doctype, docids, fields = None):
+        """ Fetches a batch of documents from the DB, returns a dict of
+            ID -> document for the ones that exist. If fields is given,
+            only those fields of each document are fetched. """
+        docs = dict(self.mget(doctype, docids, fields or True))
+        if self.idcache:
+            self.idcache.add(doctype, docs.keys())
+        return docs
+
+    def exists_many(self, doctype, docids):
+        """ Checks which of a batch of documents exist, returns the set
+            of IDs that do """
+        docids = list(docids)
+        found = set()
+        if self.idcache:
+            self.warm(doctype)
+            found = self.idcache.known(doctype, docids)
+        rest = set(docid for docid, doc in self.mget(doctype, [docid for docid in docids if docid not in found], source = False))
+        if self.idcache:
+            self.idcache.add(doctype, rest)
+        return found | rest
 
     def index(self, doctype, docid, document):
         """ Adds a new document to the index """
         dbname = self.broker.config['elasticsearch']['database']
         self.broker.DB.index(index=dbname, doc_type = doctype, id = docid, body = document)
+        if self.idcache:
+            self.idcache.add(doctype, [docid])
 
     def append(self, t, doc):
         """ Append a document to the bulk push queue """
@@ -177,51 +675,80 @@ class KibbleBit:
             sys.stderr.write("No doc ID specified!\n")
             return
         doc['doctype'] = t
-        self.json_queue.append(doc)
-        # If we've crossed the bulk limit, do a push
-        if len(self.json_queue) > self.queueMax:
-            pprint("Bulk push forced")
-            self.bulk()
+        # Only cached for good once the writer has pushed it, see bulk().
+        # Pended first, so that if ES turns the document down, the
+        # writer's forgetting it comes after.
+        if self.idcache:
+            self.idcache.pend(t, [doc['id']])
+        self.broker.writer.put(self.action(doc))
+
+    def increment(self, t, doc, counts, marker):
+        """ Queues up an addition of counts (field -> number) to a
+            document, rather than replacing it. If the document doesn't
+            exist yet, doc (with the counts as they should end up) is
+            used. ES does the adding, so this works for documents that
+            aren't in ES yet, e.g. in spool mode. An increment with a
+            marker the document has seen before is skipped, so pushing
+            the same action twice does no harm. """
+        doc = dict(doc, doctype = t, increments = [marker])
+        action = self.action(doc)
+        for key in ('_source', 'doc', 'doc_as_upsert'):
+            action.pop(key, None)
+        action['_op_type'] = 'update'
+        action['script'] = {
+            'lang': 'painless',
+            'source': INCREMENT_SCRIPT,
+            'params': {
+                'counts': counts,
+                'marker': marker
+            }
+        }
+        action['upsert'] = doc
+        if self.idcache:
+            self.idcache.pend(t, [doc['id']])
+        self.broker.writer.put(action)
+
+    def action(self, js):
+        """ Turns a document into a bulk action """
+        doc = js
+        js['@version'] = 1
+        dbname = self.broker.config['elasticsearch']['database']
+        if self.broker.noTypes:
+            dbname += "_%s" % js['doctype']
+            #del doc['doctype']
+            defaultJSON = {
+                '_op_type': 'update' if js.get('upsert') else 'index',
+                '_index': dbname,
+                '_id': js['id'],
+                'doc' if js.get('upsert') else '_source': doc,
+                'doc_as_upsert': True,
+            }
+            if self.broker.seven is False:
+                defaultJSON['_type'] = '_doc'
+            return defaultJSON
+        return {
+            '_op_type': 'update' if js.get('upsert') else 'index',
+            '_index': dbname,
+            '_type': js['doctype'],
+            '_id': js['id'],
+            'doc' if js.get('upsert') else '_source': doc,
+            'doc_as_upsert': True,
+        }
+
+    def spooling(self):
+        """ Whether bulk documents go to the local spool rather than
+            ES, in which case ES may not have them for a while """
+        return isinstance(self.broker.writer, SpoolWriter)
 
     def bulk(self):
-        """ Push pending JSON objects in the queue to ES"""
-        xjson = self.json_queue
-        js_arr = []
-        self.json_queue = []
-        for entry in xjson:
-            js = entry
-            doc = js
-            js['@version'] = 1
-            dbname = self.broker.config['elasticsearch']['database']
-            if self.broker.noTypes:
-                dbname += "_%s" % js['doctype']
-                #del doc['doctype']
-                defaultJSON = {
-                    '_op_type': 'update' if js.get('upsert') else 'index',
-                    '_index': dbname,
-                    '_id': js['id'],
-                    'doc' if js.get('upsert') else '_source': doc,
-                    'doc_as_upsert': True,
-                }
-                if self.broker.seven is False:
-                    defaultJSON['_type'] = '_doc'
-                js_arr.append( defaultJSON )
-            else:
-                js_arr.append({
-                    '_op_type': 'update' if js.get('upsert') else 'index',
-                    '_index': dbname,
-                    '_type': js['doctype'],
-                    '_id': js['id'],
-                    'doc' if js.get('upsert') else '_source': doc,
-                    'doc_as_upsert': True,
-                })
-        try:
-            res = elasticsearch.helpers.bulk(self.broker.oDB, js_arr)
-            print("Result (success,failed): ", res)
-        except Exception as err:
-            print("Error for INPUT JSON %s." % js_arr)
-            pprint("Warning: Could not bulk insert: %s" % err)
-            self.traceBack()
+        """ Push pending JSON objects in the queue to ES, and wait for it """
+        marker = self.idcache.mark() if self.idcache else None
+        self.broker.flushSources()
+        self.broker.writer.flush()
+        if self.idcache:
+            # What ES turned down has been forgotten by now
+            self.idcache.confirm(marker)
+            self.idcache.commit()
 
     def traceBack(self):
         err_type, err_value, tb = sys.exc_info()
@@ -242,7 +769,6 @@ class KibbleOrganisation:
 
     def sources(self, sourceType = None, view = None):
         """ Get all sources or sources of a specific type for an org """
-        s = []
         # Search for all sources of this organisation
         mustArray = [{
                         'term': {
@@ -269,27 +795,19 @@ class KibbleOrganisation:
                                     'type': sourceType
                                 }
                             })
-        # Run the search, fetch all results, 9999 max. TODO: Scroll???
-        res = self.broker.DB.search(
-            index=self.broker.config['elasticsearch']['database'],
-            doc_type="source",
-            size = 9999,
-            body = {
+        # Stream all matching sources, sorted by URL
+        for hit in self.broker.iterate("source", {
                 'query': {
                     'bool': {
                         'must': mustArray
                     }
                 },
-                'sort': {
-                    'sourceURL': 'asc'
-                }
-            }
-        )
-
-        for hit in res['hits']['hits']:
+                'sort': [
+                    {'sourceURL': 'asc'}
+                ]
+            }):
             if sourceType == None or hit['_source']['type'] == sourceType:
-                s.append(hit['_source'])
-        return s
+                yield hit['_source']
 
 """ Master Kibble Broker Class for direct ElasticSearch access """
 class Broker:
@@ -298,10 +816,11 @@ class Broker:
         auth = None
         if 'user' in es_config:
             auth = (es_config['user'], es_config['password'])
-        pprint("Connecting to ElasticSearch database at %s:%i..." % (es_config['hostname'], es_config.get('port', 9200)))
+        # hostname may be a list of nodes (host or host:port) to spread the load over
+        hosts = es_config['hostname'] if isinstance(es_config['hostname'], list) else [es_config['hostname']]
+        pprint("Connecting to ElasticSearch database at %s:%i..." % (", ".join(str(h) for h in hosts), es_config.get('port', 9200)))
 
         defaultELConfig = {
-            'host': es_config['hostname'],
             'port': int(es_config.get('port', 9200))
         }
         versionHint = config['elasticsearch']['versionHint']
@@ -315,10 +834,15 @@ class Broker:
             defaultELConfig['url_prefix'] = es_config.get('uri', '')
             defaultELConfig['http_auth'] = auth
 
-        es = elasticsearch.Elasticsearch([ defaultELConfig ],
-            max_retries=5,
-            retry_on_timeout=True
-        )
+        nodes = []
+        for host in hosts:
+            node = dict(defaultELConfig)
+            node['host'], _, port = str(host).partition(':')
+            if port:
+                node['port'] = int(port)
+            nodes.append(node)
+        bparallel = int((es_config.get('bulk') or {}).get('parallel', 2))
+        es = elasticsearch.Elasticsearch(nodes, **clientOptions(config, bparallel))
         es_info = es.info()
         pprint("Connected!")
         self.DB = es
@@ -357,24 +881,293 @@ class Broker:
             if apidoc['dbversion'] < KIBBLE_DB_VERSION:
                 sys.stderr.write("The database '%s' uses an older structure format (version %u) than the scanners (version %u). Please upgrade your main Kibble server.\n" % (es_config['database'], apidoc['dbversion'], KIBBLE_DB_VERSION))
                 sys.exit(-1)
+        # Bulk pushes go through a background writer. Use the same client
+        # as self.DB, so we get the auth options on 8.x as well. In spool
+        # mode, the writer goes to local files instead, see upload().
+        if (es_config.get('spool') or {}).get('dir'):
+            pprint("Spooling bulk documents to %s" % es_config['spool']['dir'])
+            self.setupWriter(SpoolWriter(getattr(self.DB, 'ES', self.oDB), config))
+        else:
+            self.setupWriter(BulkWriter(getattr(self.DB, 'ES', self.oDB), config))
+
+    def setupWriter(self, writer):
+        """ Sets up the bulk writer, and the ID caches and source status
+            bookkeeping that go with it """
+        self.writer = writer
+        self.writer.onFailed = self.forgetFailed
+        self.caches = {}
+        self.cacheLock = threading.Lock()
+        # Source status bookkeeping: what ES has (or will have) for each
+        # source, updates not sent yet, and when we last sent one.
+        self.statusDelay = float(self.config['scanner'].get('statusdelay', STATUS_DELAY))
+        self.sourceState = {}
+        self.sourceUpdates = {}
+        self.sourceSent = {}
+        self.sourceLock = threading.Lock()
+
+    def trackSource(self, source):
+        """ Remembers a source as it is stored in ES, so that later
+            status updates only need to send what changed """
+        with self.sourceLock:
+            self.sourceState[source['sourceID']] = copy.deepcopy(source)
+
+    def updateSource(self, source, final = False):
+        """ Queues up the changes to a source since it was last sent or
+            loaded, and sends them off unless we did so very recently """
+        sourceID = source['sourceID']
+        with self.sourceLock:
+            old = self.sourceState.setdefault(sourceID, {})
+            changes = self.sourceUpdates.setdefault(sourceID, {})
+            # Other scan threads may be adding steps as we go, so copy first
+            for key, value in list(source.items()):
+                if key == 'steps' and isinstance(value, dict):
+                    oldSteps = old.setdefault('steps', {})
+                    for step, status in list(value.items()):
+                        if status != oldSteps.get(step):
+                            oldSteps[step] = copy.deepcopy(status)
+                            changes.setdefault('steps', {})[step] = oldSteps[step]
+                elif value != old.get(key):
+                    old[key] = copy.deepcopy(value)
+                    changes[key] = old[key]
+            if final or time.time() - self.sourceSent.get(sourceID, 0) >= self.statusDelay:
+                self.sendSource(sourceID)
+
+    def flushSources(self):
+        """ Sends all source updates that are being held back """
+        with self.sourceLock:
+            for sourceID in list(self.sourceUpdates):
+                self.sendSource(sourceID)
+
+    def sendSource(self, sourceID):
+        """ Hands the pending changes to a source to the bulk writer.
+            Must be called with sourceLock held. """
+        changes = self.sourceUpdates.pop(sourceID, None)
+        if not changes:
+            return
+        self.sourceSent[sourceID] = time.time()
+        self.writer.put(self.sourceAction(sourceID, copy.deepcopy(changes)))
+
+    def sourceAction(self, sourceID, changes):
+        """ Returns the bulk action for a partial update of a source """
+        dbname = self.config['elasticsearch']['database']
+        action = {
+            '_op_type': 'update',
+            '_index': dbname + "_source" if self.noTypes else dbname,
+            '_id': sourceID,
+            'doc': changes,
+        }
+        if not self.noTypes:
+            action['_type'] = 'source'
+        elif self.seven is False:
+            action['_type'] = '_doc'
+        return action
+
+    def idCache(self, org):
+        """ Returns the document ID cache for an organisation, or None
+            if scanner.idcache isn't enabled """
+        iconfig = self.config['scanner'].get('idcache')
+        if not iconfig:
+            return None
+        with self.cacheLock:
+            if org not in self.caches:
+                ttl = plugins.utils.idcache.DEFAULT_TTL
+                if isinstance(iconfig, dict):
+                    ttl = int(iconfig.get('ttl', ttl))
+                path = os.path.join(self.config['scanner']['scratchdir'], org, 'kibble-idcache.db')
+                self.caches[org] = plugins.utils.idcache.IdCache(path, ttl)
+            return self.caches[org]
+
+    def forgetFailed(self, actions):
+        """ Drops documents ES wouldn't take from the ID caches, so the
+            scanners don't skip them next time around """
+        if not self.config['scanner'].get('idcache'):
+            return
+        for action in actions:
+            doc = action.get('_source') or action.get('doc') or {}
+            if 'doctype' not in doc:
+                continue # Not a scanner document, e.g. a source update
+            if doc.get('organisation'):
+                caches = [self.idCache(doc['organisation'])]
+            else:
+                with self.cacheLock:
+                    caches = list(self.caches.values())
+            for cache in caches:
+                cache.forget(doc['doctype'], [action['_id']])
+
+    def close(self):
+        """ Pushes any documents still pending, and stops the bulk writer """
+        self.flushSources()
+        self.writer.close()
+        for cache in self.caches.values():
+            cache.confirm()
+            cache.commit()
+        if self.writer.stats:
+            pprint("Bulk writer: %s" % self.writer.summary())
+
+    def replay(self, path = None):
+        """ Pushes the documents in a dead letter file to ES again. Those
+            that fail again end up in a new dead letter file. """
+        path = path or self.writer.deadLetterFile
+        replaying = path + ".replay"
+        # A replay that got interrupted leaves its file behind. Nothing
+        # in it is known to have made it, so it goes again, along with
+        # anything that has failed since.
+        if os.path.exists(replaying):
+            pprint("Picking up the interrupted replay in %s" % replaying)
+            if os.path.exists(path):
+                with open(replaying, "a") as out, open(path) as f:
+                    shutil.copyfileobj(f, out)
+                os.unlink(path)
+        elif os.path.exists(path):
+            os.rename(path, replaying)
+        else:
+            pprint("Nothing to replay, there is no dead letter file at %s" % path)
+            return 0
+        n = 0
+        with open(replaying) as f:
+            for line in f:
+                self.writer.put(json.loads(line)['action'])
+                n += 1
+        self.writer.flush()
+        os.unlink(replaying)
+        return n
+
+    def upload(self, follow = False, stop = None):
+        """ Drains the spool into ES, oldest segment first, at no more
+            than elasticsearch.spool.rate documents per second. A segment
+            is only removed once all of it has been pushed (or dead
+            lettered), so an interrupted upload just starts it over. With
+            follow, keeps waiting for new segments until stop is set.
+            Returns the number of documents uploaded. """
+        sconfig = self.config['elasticsearch'].get('spool') or {}
+        if not sconfig.get('dir'):
+            raise ValueError("No spool directory (elasticsearch.spool.dir) configured")
+        rate = float(sconfig.get('rate', 0)) # Max documents per second, 0 for no limit
+        poll = float(sconfig.get('poll', 10))
+        writer = BulkWriter(getattr(self.DB, 'ES', self.oDB), self.config)
+        writer.onFailed = self.forgetFailed # The scanners cached these IDs when spooling them
+        client = getattr(self.DB, 'ES', self.oDB)
+        stop = stop or threading.Event()
+        n = 0
+        while not stop.is_set():
+            todo = segments(sconfig['dir'])
+            for path in todo:
+                # Hold off while ES is down, rather than burning retries
+                while not stop.is_set() and not client.ping():
+                    pprint("ElasticSearch is not answering, waiting before uploading more")
+                    stop.wait(poll)
+                if stop.is_set():
+                    break
+                docs = 0
+                started = time.time()
+                for action in readSegment(path):
+                    writer.put(action)
+                    docs += 1
+                    if rate and docs > rate * (time.time() - started):
+                        time.sleep(docs / rate - (time.time() - started))
+                writer.flush()
+                os.unlink(path)
+                n += docs
+                pprint("Uploaded %u documents from %s" % (docs, os.path.basename(path)))
+            if not follow:
+                break
+            if not todo:
+                stop.wait(poll)
+        writer.close()
+        if writer.stats:
+            pprint("Uploader: %s" % writer.summary())
+        return n
+
+    def iterate(self, doctype, body):
+        """ Streams all the hits of a search on a document type """
+        dbname = self.config['elasticsearch']['database']
+        if self.noTypes:
+            return self.DB.iterate(dbname, doctype, body)
+        return iterate(self.DB, dbname, body, doc_type = doctype)
 
     def organisations(self):
         """ Return a list of all organisations """
-        orgs = []
-
-        # Run the search, fetch all orgs, 9999 max. TODO: Scroll???
-        res = self.DB.search(
-            index=self.config['elasticsearch']['database'],
-            doc_type="organisation",
-            size = 9999,
-            body = {
+        for hit in self.iterate("organisation", {
                 'query': {
                     'match_all': {}
-                }
-            }
-        )
-
-        for hit in res['hits']['hits']:
+                },
+                'sort': ['_doc']
+            }):
             org = hit['_source']['id']
             orgClass = KibbleOrganisation(self, org)
             yield orgClass
+
+    def acquireLease(self, sourceID, node, ttl, since):
+        """ Tries to take the scan lease on a source, for work stealing
+            between nodes. We get it if nobody has a lease on the source
+            yet, or if the old lease has run out and the source hasn't
+            been scanned since `since` (usually the start of our run). """
+        dbname = self.config['elasticsearch']['database']
+        now = time.time()
+        lease = {
+            'sourceID': sourceID,
+            'node': node,
+            'expires': now + ttl,
+            'done': 0
+        }
+        try:
+            self.DB.index(index=dbname, doc_type='lease', id=sourceID, body=lease, op_type='create')
+            return True
+        except elasticsearch.ConflictError:
+            pass
+        try:
+            res = self.DB.get(index=dbname, doc_type='lease', id=sourceID)
+        except elasticsearch.NotFoundError:
+            return False
+        old = res['_source']
+        if old['expires'] > now or old.get('done', 0) >= since:
+            return False
+        # Take over the expired lease, unless someone beats us to it
+        lease['done'] = old.get('done', 0)
+        try:
+            self.DB.index(index=dbname, doc_type='lease', id=sourceID, body=lease,
+                          if_seq_no=res['_seq_no'], if_primary_term=res['_primary_term'])
+            return True
+        except elasticsearch.ConflictError:
+            return False
+
+    def renewLease(self, sourceID, node, ttl):
+        """ Extends a lease we hold by another ttl seconds. Returns False
+            if the lease isn't ours (anymore). """
+        dbname = self.config['elasticsearch']['database']
+        try:
+            res = self.DB.get(index=dbname, doc_type='lease', id=sourceID)
+        except elasticsearch.NotFoundError:
+            return False
+        lease = res['_source']
+        if lease['node'] != node:
+            return False
+        lease['expires'] = time.time() + ttl
+        try:
+            self.DB.index(index=dbname, doc_type='lease', id=sourceID, body=lease,
+                          if_seq_no=res['_seq_no'], if_primary_term=res['_primary_term'])
+            return True
+        except elasticsearch.ConflictError:
+            return False
+
+    def releaseLease(self, sourceID, node):
+        """ Marks a source as scanned and lets go of its lease, unless
+            another node has taken it over. Returns whether it did. """
+        dbname = self.config['elasticsearch']['database']
+        try:
+            res = self.DB.get(index=dbname, doc_type='lease', id=sourceID)
+        except elasticsearch.NotFoundError:
+            return False
+        if res['_source']['node'] != node:
+            return False
+        now = time.time()
+        try:
+            self.DB.index(index=dbname, doc_type='lease', id=sourceID, body = {
+                'sourceID': sourceID,
+                'node': node,
+                'expires': now,
+                'done': now
+            }, if_seq_no=res['_seq_no'], if_primary_term=res['_primary_term'])
+            return True
+        except elasticsearch.ConflictError:
+            return False
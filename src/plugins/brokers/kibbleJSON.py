@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble HTTP JSON broker.
+It lets scanner nodes that can't reach ElasticSearch ship their data
+through the Kibble API server instead. It has the same KibbleBit
+interface as the ES broker, and shares its background bulk writer:
+documents are pushed in batches as gzipped NDJSON (in the ES bulk
+format) over a persistent, pooled HTTP session.
+
+The API server is expected to answer the following calls, relative to
+the broker.url setting. Request and response bodies are shaped like
+their ES counterparts, so the server can mostly pass them through.
+
+    GET  scanner/organisations         List of organisation IDs
+    POST scanner/sources               Sources of an organisation, as a list.
+                                       Takes {organisation, type, view}
+    POST scanner/mget/<doctype>        ES mget: {docs: [{_id, _source}]}
+    POST scanner/search/<doctype>      ES search, with ?size=N
+    POST scanner/iterate/<doctype>     All hits of an ES search, a page at a
+                                       time. Takes {body, cursor}, returns
+                                       {hits: [...], cursor}; the cursor is
+                                       null on the last page
+    POST scanner/bulk                  ES bulk (NDJSON), returns {items: [...]}
+    POST scanner/lease/<sourceID>      Takes {node, ttl, since} to take a
+                                       lease, {node, ttl, renew: true} to
+                                       extend it or {node, release: true}
+                                       to let go, returns {granted}
+"""
+
+import gzip
+import json
+import sys
+import urllib.parse
+import requests
+import requests.adapters
+import urllib3.util.retry
+import plugins.brokers.kibbleES
+import plugins.utils.concurrency
+
+pprint = plugins.brokers.kibbleES.pprint
+
+REQUEST_TIMEOUT = 30 # Default seconds before an API request times out
+CONNECT_TIMEOUT = 5 # Max seconds to wait for a connection to the API server
+TRANSIENT_HTTP = (429, 502, 503, 504) # API responses worth another go
+
+class APIError(Exception):
+    """ The API server didn't like a request """
+    pass
+
+class JSONWriter(plugins.brokers.kibbleES.BulkWriter):
+    """ Bulk writer that pushes to the Kibble API instead of ES. Batching,
+        size tuning, retries and dead lettering are all the same. """
+
+    def __init__(self, broker, config):
+        plugins.brokers.kibbleES.BulkWriter.__init__(self, broker, config, section = 'broker')
+        self.broker = broker
+
+    def request(self, batch):
+        retry = []
+        failed = []
+        lines = []
+        for action in batch:
+            op = action.get('_op_type', 'index')
+            lines.append(json.dumps({op: {'_index': action['_index'], '_id': action['_id']}}))
+            if op == 'update':
+                body = dict((key, action[key]) for key in ('doc', 'doc_as_upsert', 'script', 'upsert') if key in action)
+            else:
+                body = action['_source']
+            lines.append(json.dumps(body, default = str))
+        rv = self.broker.post("scanner/bulk", "\n".join(lines) + "\n", contentType = "application/x-ndjson")
+        if rv.status_code in TRANSIENT_HTTP:
+            return batch, []
+        if rv.status_code >= 400:
+            return [], [(action, {'status': rv.status_code, 'error': rv.text[:500]}) for action in batch]
+        for action, item in zip(batch, rv.json()['items']):
+            result = list(item.values())[0]
+            status = result.get('status', 200)
+            if status < 300:
+                continue
+            if status in plugins.brokers.kibbleES.TRANSIENT_STATUS:
+                retry.append(action)
+            else:
+                failed.append((action, result))
+        return retry, failed
+
+
+class KibbleBit(plugins.brokers.kibbleES.KibbleBit):
+    """ KibbleBit class with access through the Kibble API """
+
+    def __init__(self, broker, organisation, tid):
+        self.config = broker.config
+        self.organisation = organisation
+        self.broker = broker
+        self.pluginname = ""
+        self.tid = tid
+        self.idcache = broker.idCache(organisation.id) # Known document IDs, if enabled
+
+    def get(self, doctype, docid):
+        """ Fetches a document from the DB """
+        return self.get_many(doctype, [docid]).get(docid)
+
+    def search(self, doctype, body, size = 100):
+        """ Runs a search on a document type, returns the raw ES response """
+        return self.broker.call("scanner/search/%s?size=%u" % (doctype, size), body)
+
+    def exists(self, doctype, docid):
+        """ Checks whether a document already exists or not """
+        return docid in self.exists_many(doctype, [docid])
+
+    def warm(self, doctype):
+        # The API has no cheap way of listing all IDs, so the ID cache
+        # only learns from lookups and writes here.
+        pass
+
+    def mget(self, doctype, ids, source = True):
+        """ Looks up documents in batches of MGET_SIZE, yielding
+            (id, document) for every one that exists """
+        ids = list(dict.fromkeys(ids))
+        for i in range(0, len(ids), plugins.brokers.kibbleES.MGET_SIZE):
+            res = self.broker.call("scanner/mget/%s" % doctype, {
+                'docs': [{'_id': docid, '_source': source} for docid in ids[i:i+plugins.brokers.kibbleES.MGET_SIZE]]
+            })
+            for doc in res['docs']:
+                if doc.get('found'):
+                    yield doc['_id'], doc.get('_source')
+
+    def index(self, doctype, docid, document):
+        """ Adds a new document to the index, right away """
+        retry, failed = self.broker.writer.request([{
+            '_op_type': 'index',
+            '_index': doctype,
+            '_id': docid,
+            '_source': document
+        }])
+        if retry or failed:
+            raise APIError("Could not index %s document %s: %s" % (doctype, docid, failed[0][1] if failed else "server busy"))
+        if self.idcache:
+            self.idcache.add(doctype, [docid])
+
+    def action(self, js):
+        """ Turns a document into a bulk action. The API server works
+            out which index each document type goes to. """
+        js['@version'] = 1
+        return {
+            '_op_type': 'update' if js.get('upsert') else 'index',
+            '_index': js['doctype'],
+            '_id': js['id'],
+            'doc' if js.get('upsert') else '_source': js,
+            'doc_as_upsert': True,
+        }
+
+
+class KibbleOrganisation:
+    """ KibbleOrg with access through the Kibble API """
+    def __init__(self, broker, org):
+        self.broker = broker
+        self.id = org
+
+    def sources(self, sourceType = None, view = None):
+        """ Get all sources or sources of a specific type for an org """
+        for source in self.broker.call("scanner/sources", {
+                'organisation': self.id,
+                'type': sourceType,
+                'view': view
+            }):
+            if sourceType == None or source['type'] == sourceType:
+                yield source
+
+""" Master Kibble Broker Class for access through the Kibble API """
+class Broker(plugins.brokers.kibbleES.Broker):
+    def __init__(self, config):
+        bconfig = config['broker']
+        self.url = bconfig['url'].rstrip('/') + '/'
+        pprint("Connecting to the Kibble API at %s..." % self.url)
+        self.config = config
+        self.bitClass = KibbleBit
+        self.timeout = (CONNECT_TIMEOUT, float(bconfig.get('timeout', REQUEST_TIMEOUT)))
+        self.compress = bconfig.get('compress', True)
+        # One session for everything, so connections are kept alive and
+        # shared. Connection errors and busy servers get a few retries.
+        retries = urllib3.util.retry.Retry(
+            total = int(bconfig.get('retries', 3)),
+            backoff_factor = 1,
+            status_forcelist = TRANSIENT_HTTP,
+            allowed_methods = False,
+            raise_on_status = False
+        )
+        cconfig = plugins.utils.concurrency.CONFIG
+        threads = plugins.utils.concurrency.workers() * int(cconfig.get('threads', plugins.utils.concurrency.DEFAULT_THREADS))
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize = int(bconfig.get('maxsize', threads + 4)), max_retries = retries)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json",
+            "User-Agent": "Apache Kibble",
+        })
+        auth = bconfig.get('auth')
+        if auth:
+            self.session.auth = (auth['username'], auth['password'])
+        self.setupWriter(JSONWriter(self, config))
+        # Make sure the API server is there (and lets us in)
+        try:
+            self.call("scanner/organisations")
+        except (APIError, requests.RequestException) as err:
+            sys.stderr.write("Could not talk to the Kibble API at %s: %s\n" % (self.url, err))
+            sys.exit(-1)
+        pprint("Connected!")
+
+    def post(self, path, data, contentType = "application/json"):
+        """ POSTs a request body to the API, gzipped if enabled """
+        headers = {"Content-Type": contentType}
+        data = data.encode('utf-8')
+        if self.compress:
+            data = gzip.compress(data, compresslevel = 5)
+            headers["Content-Encoding"] = "gzip"
+        return self.session.post(self.url + path, data = data, headers = headers, timeout = self.timeout)
+
+    def call(self, path, body = None):
+        """ Calls the API (GET without a body, POST with one), returns the JSON response """
+        if body is None:
+            rv = self.session.get(self.url + path, timeout = self.timeout)
+        else:
+            rv = self.post(path, json.dumps(body, default = str))
+        if rv.status_code >= 400:
+            raise APIError("API call to %s failed with status code %u: %s" % (path, rv.status_code, rv.text[:500]))
+        return rv.json()
+
+    def sourceAction(self, sourceID, changes):
+        return {
+            '_op_type': 'update',
+            '_index': 'source',
+            '_id': sourceID,
+            'doc': changes,
+        }
+
+    def iterate(self, doctype, body):
+        """ Streams all the hits of a search on a document type, fetching
+            them from the API a page at a time """
+        cursor = None
+        while True:
+            page = self.call("scanner/iterate/%s" % doctype, {
+                'body': body,
+                'cursor': cursor
+            })
+            yield from page['hits']
+            cursor = page.get('cursor')
+            if not cursor or not page['hits']:
+                break
+
+    def upload(self, follow = False, stop = None):
+        raise ValueError("There is no spool to upload with the HTTP JSON broker, --upload needs the ElasticSearch broker")
+
+    def organisations(self):
+        """ Return a list of all organisations """
+        for org in self.call("scanner/organisations"):
+            yield KibbleOrganisation(self, org)
+
+    def acquireLease(self, sourceID, node, ttl, since):
+        """ Tries to take the scan lease on a source, see the ES broker """
+        return bool(self.call("scanner/lease/%s" % urllib.parse.quote(sourceID, safe = ''), {
+            'node': node,
+            'ttl': ttl,
+            'since': since
+        }).get('granted'))
+
+    def renewLease(self, sourceID, node, ttl):
+        """ Extends a lease we hold, see the ES broker """
+        return bool(self.call("scanner/lease/%s" % urllib.parse.quote(sourceID, safe = ''), {
+            'node': node,
+            'ttl': ttl,
+            'renew': True
+        }).get('granted'))
+
+    def releaseLease(self, sourceID, node):
+        """ Marks a source as scanned and lets go of its lease, if it is
+            still ours """
+        return bool(self.call("scanner/lease/%s" % urllib.parse.quote(sourceID, safe = ''), {
+            'node': node,
+            'release': True
+        }).get('granted'))
@@ -18,13 +18,21 @@
 """
 This file contains, in execution order, a list of the available
 scanners that Kibble has.
+
+Scanners that need another scanner to have run on a source first
+declare it in a module-level `dependencies` list, e.g.:
+
+    dependencies = ['git-sync']
+
+Scanners on the same source that do not depend on each other may be
+run at the same time, by different workers.
 """
 
 import importlib
 
 # Define, in order of priority, all scanner plugins we have
 __all__ = [
-    'git-sync',     # This needs to precede other VCS scanners!
+    'git-sync',     # Other VCS scanners depend on this one
     'git-census',
     'git-sloc',
     'git-evolution',
@@ -24,6 +24,7 @@ import hashlib
 import datetime
 from threading import Thread, Lock
 import plugins.utils.jsonapi
+import plugins.utils.concurrency
 import urllib
 
 title = "Scanner for BugZilla"
@@ -101,16 +102,25 @@ def pchange(js):
     return False
 
 
-def scanTicket(bug, KibbleBit, source, openTickets, u, dom):
+def ticketHash(source, key):
+    """ Returns the document ID of a ticket """
+    return hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceURL'], key) ).encode('ascii', errors='replace')).hexdigest()
+
+def scanTicket(bug, KibbleBit, source, openTickets, u, dom, known = None):
     try:
         key = bug['id']
-        dhash = hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceURL'], key) ).encode('ascii', errors='replace')).hexdigest()
-        found = KibbleBit.exists('issue', dhash)
+        dhash = ticketHash(source, key)
+        # known holds the tickets we already have, if looked up in bulk
+        if known is not None:
+            ticket = known.get(dhash)
+            found = ticket is not None
+        else:
+            found = KibbleBit.exists('issue', dhash)
+            ticket = KibbleBit.get('issue', dhash) if found else None
         parseIt = False
         if not found:
             parseIt = True
         else:
-            ticket = KibbleBit.get('issue', dhash)
             if ticket['status'] == 'closed' and key in openTickets:
                 KibbleBit.pprint("Ticket was reopened, reparsing")
                 parseIt = True
@@ -243,7 +253,7 @@ def scanTicket(bug, KibbleBit, source, openTickets, u, dom):
 
 class bzThread(Thread):
 
-    def __init__(self, KibbleBit, source, block, pt, ot, u, dom):
+    def __init__(self, KibbleBit, source, block, pt, ot, u, dom, known = None):
         super(bzThread, self).__init__()
         self.KibbleBit = KibbleBit
         self.source = source
@@ -252,6 +262,7 @@ class bzThread(Thread):
         self.openTickets = ot
         self.u = u
         self.dom = dom
+        self.known = known
 
     def run(self):
         badOnes = 0
@@ -269,7 +280,7 @@ class bzThread(Thread):
                 self.block.release()
                 return
             self.block.release()
-            if not scanTicket(rl, self.KibbleBit, self.source, self.openTickets, self.u, self.dom):
+            if not scanTicket(rl, self.KibbleBit, self.source, self.openTickets, self.u, self.dom, self.known):
                 self.KibbleBit.pprint("Ticket %s seems broken, skipping" % rl['id'])
                 badOnes += 1
                 if badOnes > 50:
@@ -356,11 +367,17 @@ def scan(KibbleBit, source):
 
         KibbleBit.pprint("Found %u open tickets, %u closed." % (len(openTickets), len(pendingTickets) - len(openTickets)))
 
+        # Look up the tickets we already have in one go, rather than
+        # one request per ticket.
+        known = KibbleBit.get_many('issue', [ticketHash(source, bug['id']) for bug in pendingTickets], ['status'])
+
         badOnes = 0
         block = Lock()
         threads = []
-        for i in range(0,4):
-            t = bzThread(KibbleBit, source, block, pendingTickets, openTickets, u, dom)
+        threadCount = plugins.utils.concurrency.threads('bugzilla', u)
+        KibbleBit.pprint("Scanning tickets using %u sub-threads" % threadCount)
+        for i in range(0,threadCount):
+            t = bzThread(KibbleBit, source, block, pendingTickets, openTickets, u, dom, known)
             threads.append(t)
             t.start()
 
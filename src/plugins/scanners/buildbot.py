@@ -21,6 +21,7 @@ import re
 import json
 import hashlib
 import plugins.utils.jsonapi
+import plugins.utils.concurrency
 import threading
 import requests.exceptions
 import os
@@ -42,11 +43,6 @@ def accepts(source):
 def scanJob(KibbleBit, source, job, creds):
     """ Scans a single job for activity """
     NOW = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-    dhash = hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceID'], job) ).encode('ascii', errors='replace')).hexdigest()
-    found = True
-    doc= None
-    parseIt = False
-    found = KibbleBit.exists('cijob', dhash)
 
     jobURL = "%s/api/v2/builders/%s/builds" % (source['sourceURL'], job)
     KibbleBit.pprint(jobURL)
@@ -54,13 +50,18 @@ def scanJob(KibbleBit, source, job, creds):
 
     # If valid JSON, ...
     if jobjson:
+        buildhashes = {}
+        for buildno in jobjson:
+            buildhashes[buildno] = hashlib.sha224( ("%s-%s-%s-%s" % (source['organisation'], source['sourceID'], job, buildno) ).encode('ascii', errors='replace')).hexdigest()
+        # Look up the builds we already have in one go
+        known = {}
+        try:
+            known = KibbleBit.get_many('ci_build', buildhashes.values(), ['completed'])
+        except:
+            pass
         for buildno, data in jobjson.items():
-            buildhash = hashlib.sha224( ("%s-%s-%s-%s" % (source['organisation'], source['sourceID'], job, buildno) ).encode('ascii', errors='replace')).hexdigest()
-            builddoc = None
-            try:
-                builddoc = KibbleBit.get('ci_build', buildhash)
-            except:
-                pass
+            buildhash = buildhashes[buildno]
+            builddoc = known.get(buildhash)
 
             # If this build already completed, no need to parse it again
             if builddoc and builddoc.get('completed', False):
@@ -243,8 +244,9 @@ def scan(KibbleBit, source):
 
         threads = []
         block = threading.Lock()
-        KibbleBit.pprint("Scanning jobs using 4 sub-threads")
-        for i in range(0,4):
+        threadCount = plugins.utils.concurrency.threads('buildbot', source['sourceURL'])
+        KibbleBit.pprint("Scanning jobs using %u sub-threads" % threadCount)
+        for i in range(0,threadCount):
             t = buildbotThread(block, KibbleBit, source, creds, jobs)
             threads.append(t)
             t.start()
@@ -21,6 +21,7 @@ import re
 import json
 import hashlib
 import plugins.utils.jsonapi
+import plugins.utils.concurrency
 import threading
 import requests.exceptions
 import os
@@ -71,6 +72,7 @@ def scanJob(KibbleBit, source, cat, creds):
             m = re.match(r"https?://([-a-zA-Z0-9.]+)", source['sourceURL'])
             if m:
                 fakeDomain = m.group(1)
+            newUsers = []
             for user in catjson['users']:
                 # Fake email address, compute deterministic ID
                 email = "%s@%s" % (user['username'], fakeDomain)
@@ -87,17 +89,27 @@ def scanJob(KibbleBit, source, cat, creds):
                 # Store user-ID-to-username mapping for later
                 allUsers[user['id']] = userDoc
 
-                # Store it (or, queue storage) unless it exists.
-                # We don't wanna override better data, so we check if
-                # it's there first.
-                if not KibbleBit.exists('person', dhash):
+                newUsers.append(userDoc)
+
+            # Store them (or, queue storage) unless they exist.
+            # We don't wanna override better data, so we check if
+            # they're there first, all in one go.
+            known = KibbleBit.exists_many('person', [userDoc['id'] for userDoc in newUsers])
+            for userDoc in newUsers:
+                if not userDoc['id'] in known:
                     KibbleBit.append('person', userDoc)
 
+            # Look up the topics on this page we already have, in one go
+            topicHashes = {}
+            for topic in catjson['topic_list']['topics']:
+                topicHashes[topic['id']] = hashlib.sha224( ("%s-%s-topic-%s" % (source['organisation'], source['sourceURL'], topic['id']) ).encode('ascii', errors='replace')).hexdigest()
+            knownTopics = KibbleBit.get_many('forum_topic', topicHashes.values(), ['updated'])
+
             # Now, for each topic, we'll store a topic document
             for topic in catjson['topic_list']['topics']:
 
                 # Calculate topic ID
-                dhash = hashlib.sha224( ("%s-%s-topic-%s" % (source['organisation'], source['sourceURL'], topic['id']) ).encode('ascii', errors='replace')).hexdigest()
+                dhash = topicHashes[topic['id']]
 
                 # Figure out when topic was created and updated
                 CreatedDate = datetime.datetime.strptime(topic['created_at'], "%Y-%m-%dT%H:%M:%S.%fZ").timestamp()
@@ -108,8 +120,8 @@ def scanJob(KibbleBit, source, cat, creds):
 
                 # Determine whether we should scan this topic or continue to the next one.
                 # We'll do this by seeing if the topic already exists and has no changes or not.
-                if KibbleBit.exists('forum_topic', dhash):
-                    fdoc = KibbleBit.get('forum_topic', dhash)
+                if dhash in knownTopics:
+                    fdoc = knownTopics[dhash]
                     # If update in the old doc was >= current update timestamp, skip the topic
                     if fdoc['updated'] >= UpdatedDate:
                         continue
@@ -283,8 +295,9 @@ def scan(KibbleBit, source):
         # Now fire off 4 threads to parse the categories
         threads = []
         block = threading.Lock()
-        KibbleBit.pprint("Scanning jobs using 4 sub-threads")
-        for i in range(0,4):
+        threadCount = plugins.utils.concurrency.threads('discourse', source['sourceURL'])
+        KibbleBit.pprint("Scanning jobs using %u sub-threads" % threadCount)
+        for i in range(0,threadCount):
             t = discourseThread(block, KibbleBit, source, creds, pendingJobs)
             threads.append(t)
             t.start()
@@ -21,6 +21,7 @@ import hashlib
 from dateutil import parser
 import time
 import json
+import plugins.utils.concurrency
 
 title = "Scanner for Gerrit Code Review"
 version = "0.1.1"
@@ -42,7 +43,8 @@ def getjson(response):
     return json.loads(response.text[4:])
 
 def get(url, params=None):
-    resp = requests.get(url, params=params)
+    with plugins.utils.concurrency.host(url):
+        resp = requests.get(url, params=params)
     return getjson(resp)
 
 def changes(base_url, params=None):
@@ -15,16 +15,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
-import re
-import subprocess
+import sys
 import time
-import tempfile
+import itertools
 import hashlib
 import email.utils
 import datetime, time
+import plugins.utils.git
+import plugins.utils.concurrency
 
 title = "Census Scanner for Git"
 version = "0.1.0"
+cpubound = True # Can be run in a worker process (--workers-mode process)
+dependencies = ['git-sync']
+FILE_BATCH = 1000 # Files to look up and push at a time when recording file changes
 
 
 def accepts(source):
@@ -37,14 +41,33 @@ def accepts(source):
     return False
 
 
+class Rollup:
+    """ Daily totals for one author in one repository """
+    __slots__ = ('name', 'commits', 'insertions', 'deletions', 'files')
+
+    def __init__(self, name):
+        self.name = name
+        self.commits = 0
+        self.insertions = 0
+        self.deletions = 0
+        self.files = 0
+
+
+class FileState:
+    """ The last change to a file, and when it first showed up. There is
+        one of these per file in the repository, so keep it small. """
+    __slots__ = ('hash', 'timestamp', 'created', 'author_email', 'committer_email')
+
+    def __init__(self, ch, ct, created, ae, ce):
+        self.hash = ch
+        self.timestamp = ct
+        self.created = created
+        self.author_email = ae
+        self.committer_email = ce
+
+
 def scan(KibbleBit, source):
     """ Conduct a census scan """
-    people = {}
-    idseries = {}
-    lcseries = {}
-    alcseries = {}
-    ctseries = {}
-    atseries = {}
 
     rid = source['sourceID']
     url = source['sourceURL']
@@ -62,204 +85,224 @@ def scan(KibbleBit, source):
                 'good': True,
             }
         KibbleBit.updateSource(source)
-        gname = rid
-        inp = ""
+        gitdir = os.path.join(gpath, '.git')
         modificationDates = {}
-        # Did we do a census before?
-        if 'census' in source and source['census'] > 0:
-            # Go back 2 months, meh...
-            ts = source['census'] - (62*86400)
-            pd = time.gmtime(ts)
-            date = time.strftime("%Y-%b-%d 0:00", pd)
-            inp = subprocess.check_output("git --git-dir %s/.git log --after=\"%s\" --all \"--pretty=format:::%%H|%%ce|%%cn|%%ae|%%an|%%ct\" --numstat" % (gpath, date), shell = True)
+        rollups = {} # (day, author email) -> Rollup
+        args = ['--all']
+        revisions = None
+        full = True
+        tips = plugins.utils.git.tips(gitdir)
+        # Did we do a census before? Then we only need the commits that
+        # can't be reached from the ref tips we saw back then. If some of
+        # those tips are gone (force pushes etc), we'd see old commits
+        # again and count them twice in the daily rollups, so we start
+        # over. Sources without rollups yet get a full census once, too.
+        if source.get('census_tips') and source.get('census_rollups'):
+            # Only commits count; older runs may have stored tips of
+            # tags that point at trees or blobs.
+            known = plugins.utils.git.objectTypes(gitdir, set(source['census_tips']))
+            old = set(tip for tip, kind in known.items() if kind == 'commit')
+            if None not in known.values():
+                full = False
+                revisions = ["^%s" % tip for tip in old]
+                if tips <= old:
+                    args = None
+            else:
+                KibbleBit.pprint("History of %s (%s) was rewritten, doing a full census" % (rid, url))
+        if args is None:
+            KibbleBit.pprint("No new commits in %s (%s)" % (rid, url))
+            commits = []
         else:
-            inp = subprocess.check_output("git --git-dir %s/.git log --all \"--pretty=format:::%%H|%%ce|%%cn|%%ae|%%an|%%ct\" --numstat" % gpath, shell = True)
-        tmp = tempfile.NamedTemporaryFile(mode='w+b', buffering=1, delete=False)
-        tmp.write(inp)
-        tmp.flush()
-        tmp.close()
-        with open(tmp.name, mode="r", encoding="utf-8", errors='replace') as f:
-            inp = f.read()
-            f.close()
-        os.unlink(tmp.name)
-        edone = 0
-        KibbleBit.pprint("Parsing log for %s (%s)..." % (rid, url))
-        for m in re.finditer(u":([a-f0-9]+)\|([^\r\n|]+)\|([^\r\n|]+)\|([^\r\n|]+)\|([^\r\n|]+)\|([\d+]+)\r?\n([^:]+?):", inp, flags=re.MULTILINE):
-            if m:
-                ch = m.group(1)
-                ce = m.group(2)
-                cn = m.group(3)
-                ae = m.group(4)
-                an = m.group(5)
-                ct = int(m.group(6))
-                diff = m.group(7)
-                insert = 0
-                delete = 0
-                files_touched = set()
-                # Diffs
-                for l in re.finditer(u"(\d+)[ \t]+(\d+)[ \t]+([^\r\n]+)", diff, flags=re.MULTILINE):
-                    insert += int(l.group(1))
-                    delete += int(l.group(2))
-                    filename = l.group(3)
-                    if filename:
-                        files_touched.update([filename])
-                    if filename and len(filename) > 0 and (not filename in modificationDates or modificationDates[filename]['timestamp'] < ct):
-                        modificationDates[filename] = {
-                            'hash': ch,
-                            'filename': filename,
-                            'timestamp': ct,
-                            'created': ct if (not filename in modificationDates or not 'created' in modificationDates[filename] or modificationDates[filename]['created'] > ct) else modificationDates[filename]['created'],
-                            'author_email': ae,
-                            'committer_email': ce
-                            }
-                    if insert > 100000000:
-                        insert = 0
-                    if delete > 100000000:
-                        delete = 0
-                    if delete > 1000000 or insert > 1000000:
-                        KibbleBit.pprint("gigantic diff for %s (%s), ignoring" % (gpath, source['sourceURL']))
-                        pass
-                if not gname in idseries:
-                    idseries[gname] = {}
-                if not gname in lcseries:
-                    lcseries[gname] = {}
-                if not gname in alcseries:
-                    alcseries[gname] = {}
-                if not gname in ctseries:
-                    ctseries[gname] = {}
-                if not gname in atseries:
-                    atseries[gname] = {}
-                ts = ct - (ct % 86400)
-                if not ts in idseries[gname]:
-                    idseries[gname][ts] = [0,0]
-
-                idseries[gname][ts][0] += insert
-                idseries[gname][ts][1] += delete
+            KibbleBit.pprint("Parsing log for %s (%s)..." % (rid, url))
+            # Commits are parsed (and their documents queued up) as git
+            # produces them, so the log never has to fit in memory. Big
+            # histories are split up between several git processes.
+            commits = plugins.utils.git.parallelLog(gitdir, *args, revisions = revisions,
+                                                    workers = plugins.utils.concurrency.threads('git-census'))
+        for ch, ce, cn, ae, an, ct, files in commits:
+            # Merges (and empty commits) have no diff, and don't count
+            if not files:
+                continue
+            insert = 0
+            delete = 0
+            files_touched = set()
+            # The same few people show up in a lot of file states
+            ae = sys.intern(ae)
+            ce = sys.intern(ce)
+            # Diffs
+            for finsert, fdelete, filename in files:
+                # Binary files have no line counts, skip them
+                if finsert is None or fdelete is None:
+                    continue
+                insert += finsert
+                delete += fdelete
+                if filename:
+                    files_touched.update([filename])
+                # Keep the last change to a file, and when it first showed
+                # up. Commits may come in any order, so ties go to the
+                # highest hash to get the same result every time.
+                entry = modificationDates.get(filename) if filename else None
+                if filename and (entry is None or (entry.timestamp, entry.hash) < (ct, ch)):
+                    modificationDates[filename] = FileState(ch, ct, min(ct, entry.created) if entry else ct, ae, ce)
+                elif entry and ct < entry.created:
+                    entry.created = ct
+                if insert > 100000000:
+                    insert = 0
+                if delete > 100000000:
+                    delete = 0
+                if delete > 1000000 or insert > 1000000:
+                    KibbleBit.pprint("gigantic diff for %s (%s), ignoring" % (gpath, source['sourceURL']))
+                    pass
+            ts = ct - (ct % 86400)
 
-                if not ts in lcseries[gname]:
-                    lcseries[gname][ts] = {}
-                if not ts in alcseries[gname]:
-                    alcseries[gname][ts] = {}
-                if not ce in lcseries[gname][ts]:
-                    lcseries[gname][ts][ce] = [0,0]
-                lcseries[gname][ts][ce][0]  = lcseries[gname][ts][ce][0] + insert
-                lcseries[gname][ts][ce][1]  = lcseries[gname][ts][ce][0] + delete
+            # Daily rollup for the author
+            rollup = rollups.get((ts, ae))
+            if rollup is None:
+                rollup = rollups[(ts, ae)] = Rollup(an)
+            rollup.commits += 1
+            rollup.insertions += insert
+            rollup.deletions += delete
+            rollup.files += len(files_touched)
 
-                if not ae in alcseries[gname][ts]:
-                    alcseries[gname][ts][ae] = [0,0]
-                alcseries[gname][ts][ae][0]  = alcseries[gname][ts][ae][0] + insert
-                alcseries[gname][ts][ae][1]  = alcseries[gname][ts][ae][0] + delete
+            # Make a list of changed files, max 1024
+            filelist = list(files_touched)
+            filelist = filelist[:1023]
 
-                if not ts in ctseries[gname]:
-                    ctseries[gname][ts] = {}
-                if not ts in atseries[gname]:
-                    atseries[gname][ts] = {}
-
-                if not ce in ctseries[gname][ts]:
-                    ctseries[gname][ts][ce] = 0
-                ctseries[gname][ts][ce] += 1
-
-                if not ae in atseries[gname][ts]:
-                    atseries[gname][ts][ae] = 0
-                atseries[gname][ts][ae] += 1
-
-                # Committer
-                if not ce in people or len(people[ce]['name']) < len(cn):
-                    people[ce] = people[ce] if ce in people else {'projects': [gname]}
-                    people[ce]['name'] = cn
-                    if not gname in people[ce]['projects']:
-                        people[ce]['projects'].append(gname)
-
-                # Author
-                if not ae in people or len(people[ae]['name']) < len(an):
-                    people[ae] = people[ae] if ae in people else {'projects': [gname]}
-                    people[ae]['name'] = an
-                    if not gname in people[ae]['projects']:
-                        people[ae]['projects'].append(gname)
+            # ES commit documents
+            tsd = ts - (ts % 86400)
+            js = {
+                'id': rid + "/" + ch,
+                'sourceID': rid,
+                'sourceURL': source['sourceURL'],
+                'organisation': source['organisation'],
+                'ts': ct,
+                'tsday': tsd,
+                'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(ct)),
+                'committer_name': cn,
+                'committer_email': ce,
+                'author_name': an,
+                'author_email': ae,
+                'insertions': insert,
+                'deletions': delete,
+                'vcs': 'git',
+                'files_changed': filelist
+            }
+            jsx = {
+                'id': ch,
+                'organisation': source['organisation'],
+                'sourceID': source['sourceID'], # Only ever the last source with this
+                'ts': ct,
+                'tsday': tsd,
+                'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(ct)),
+                'committer_name': cn,
+                'committer_email': ce,
+                'author_name': an,
+                'author_email': ae,
+                'insertions': insert,
+                'deletions': delete,
+                'repository': rid, # This will always ever only be the last repo that had it!
+                'vcs': 'git',
+                'files_changed': filelist
+            }
+            KibbleBit.append ( 'person', {
+                'upsert': True,
+                'name': cn,
+                'email': ce,
+                'address': ce,
+                'organisation': source['organisation'],
+                'id' : hashlib.sha1( ("%s%s" % (source['organisation'], ce)).encode('ascii', errors='replace')).hexdigest()
+            })
+            KibbleBit.append ( 'person',
+                {
+                'upsert': True,
+                'name': an,
+                'email': ae,
+                'address': ae,
+                'organisation': source['organisation'],
+                'id' :hashlib.sha1( ("%s%s" % (source['organisation'], ae)).encode('ascii', errors='replace')).hexdigest()
+            }
+                )
+            KibbleBit.append('code_commit', js)
+            KibbleBit.append('code_commit_unique', jsx)
 
-                # Make a list of changed files, max 1024
-                filelist = list(files_touched)
-                filelist = filelist[:1023]
+        if True: # Do file changes?? Might wanna make this optional
+            KibbleBit.pprint("Scanning file changes for %s" % source['sourceURL'])
+            # A batch at a time, so we don't hold an ID for every file at once
+            files = iter(modificationDates.items())
+            while True:
+                batch = list(itertools.islice(files, FILE_BATCH))
+                if not batch:
+                    break
+                fids = [hashlib.sha1( ("%s/%s" % (source['sourceID'], filename)).encode('ascii', errors='replace')).hexdigest() for filename, state in batch]
+                # Look up which files we already know of in one go
+                known = KibbleBit.exists_many('file_history', fids)
+                for fid, (filename, state) in zip(fids, batch):
+                    jsfe = {
+                            'upsert': True,
+                            'id': fid,
+                            'organisation': source['organisation'],
+                            'sourceID': source['sourceID'],
+                            'ts': state.timestamp,
+                            'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(state.timestamp)),
+                            'committer_email': state.committer_email,
+                            'author_email': state.author_email,
+                            'hash': state.hash,
+                            'created': state.created,
+                            'createdDate': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(state.created))
+                        }
+                    if fid in known:
+                        del jsfe['created']
+                        del jsfe['createdDate']
+                    KibbleBit.append('file_history', jsfe)
 
-                # ES commit documents
-                tsd = ts - (ts % 86400)
-                js = {
-                    'id': rid + "/" + ch,
+        # Daily rollups. After a full census they are complete as they
+        # are, otherwise the new commits are added to what we had. If we
+        # fail halfway, the next census has to start over, so as not to
+        # add anything twice, so the flag saying so is pushed to ES
+        # before we write a single rollup. In spool mode, ES may not have
+        # the rollups of our last run yet, so we can't look them up;
+        # instead, ES adds the new counts itself once they are uploaded.
+        spooled = not full and KibbleBit.spooling()
+        marker = hashlib.sha1( ("%s/%s" % (rid, ",".join(sorted(tips)))).encode('ascii', errors='replace')).hexdigest()
+        if not full and rollups:
+            source['census_rollups'] = False
+            KibbleBit.updateSource(source, final = True)
+            KibbleBit.bulk()
+        KibbleBit.pprint("Writing %u daily rollups for %s" % (len(rollups), source['sourceURL']))
+        days = iter(rollups.items())
+        while True:
+            batch = list(itertools.islice(days, FILE_BATCH))
+            if not batch:
+                break
+            rids = [hashlib.sha1( ("%s/%u/%s" % (rid, day, ae)).encode('ascii', errors='replace')).hexdigest() for (day, ae), rollup in batch]
+            known = {} if full or spooled else KibbleBit.get_many('code_rollup', rids, ['commits', 'insertions', 'deletions', 'files'])
+            for docid, ((day, ae), rollup) in zip(rids, batch):
+                prev = known.get(docid) or {}
+                doc = {
+                    'id': docid,
+                    'organisation': source['organisation'],
                     'sourceID': rid,
                     'sourceURL': source['sourceURL'],
-                    'organisation': source['organisation'],
-                    'ts': ct,
-                    'tsday': tsd,
-                    'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(ct)),
-                    'committer_name': cn,
-                    'committer_email': ce,
-                    'author_name': an,
-                    'author_email': ae,
-                    'insertions': insert,
-                    'deletions': delete,
-                    'vcs': 'git',
-                    'files_changed': filelist
-                }
-                jsx = {
-                    'id': ch,
-                    'organisation': source['organisation'],
-                    'sourceID': source['sourceID'], # Only ever the last source with this
-                    'ts': ct,
-                    'tsday': tsd,
-                    'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(ct)),
-                    'committer_name': cn,
-                    'committer_email': ce,
-                    'author_name': an,
+                    'ts': day,
+                    'tsday': day,
+                    'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(day)),
+                    'author_name': rollup.name,
                     'author_email': ae,
-                    'insertions': insert,
-                    'deletions': delete,
-                    'repository': rid, # This will always ever only be the last repo that had it!
-                    'vcs': 'git',
-                    'files_changed': filelist
+                    'commits': rollup.commits + prev.get('commits', 0),
+                    'insertions': rollup.insertions + prev.get('insertions', 0),
+                    'deletions': rollup.deletions + prev.get('deletions', 0),
+                    'files': rollup.files + prev.get('files', 0),
+                    'vcs': 'git'
                 }
-                KibbleBit.append ( 'person', {
-                    'upsert': True,
-                    'name': cn,
-                    'email': ce,
-                    'address': ce,
-                    'organisation': source['organisation'],
-                    'id' : hashlib.sha1( ("%s%s" % (source['organisation'], ce)).encode('ascii', errors='replace')).hexdigest()
-                })
-                KibbleBit.append ( 'person',
-                    {
-                    'upsert': True,
-                    'name': an,
-                    'email': ae,
-                    'address': ae,
-                    'organisation': source['organisation'],
-                    'id' :hashlib.sha1( ("%s%s" % (source['organisation'], ae)).encode('ascii', errors='replace')).hexdigest()
-                }
-                    )
-                KibbleBit.append('code_commit', js)
-                KibbleBit.append('code_commit_unique', jsx)
-
-        if True: # Do file changes?? Might wanna make this optional
-            KibbleBit.pprint("Scanning file changes for %s" % source['sourceURL'])
-            for filename in modificationDates:
-                fid = hashlib.sha1( ("%s/%s" % (source['sourceID'], filename)).encode('ascii', errors='replace')).hexdigest()
-                jsfe = {
-                        'upsert': True,
-                        'id': fid,
-                        'organisation': source['organisation'],
-                        'sourceID': source['sourceID'],
-                        'ts': modificationDates[filename]['timestamp'],
-                        'date': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(modificationDates[filename]['timestamp'])),
-                        'committer_email': modificationDates[filename]['committer_email'],
-                        'author_email': modificationDates[filename]['author_email'],
-                        'hash': modificationDates[filename]['hash'],
-                        'created': modificationDates[filename]['created'],
-                        'createdDate': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(modificationDates[filename]['created']))
-                    }
-                found = KibbleBit.exists('file_history', fid)
-                if found:
-                    del jsfe['created']
-                    del jsfe['createdDate']
-                KibbleBit.append('file_history', jsfe)
+                if spooled:
+                    KibbleBit.increment('code_rollup', doc, {
+                        'commits': rollup.commits,
+                        'insertions': rollup.insertions,
+                        'deletions': rollup.deletions,
+                        'files': rollup.files
+                    }, marker)
+                else:
+                    KibbleBit.append('code_rollup', doc)
 
         source['steps']['census'] = {
                 'time': time.time(),
@@ -268,4 +311,6 @@ def scan(KibbleBit, source):
                 'good': True,
             }
         source['census'] = time.time()
+        source['census_tips'] = sorted(tips)
+        source['census_rollups'] = True
         KibbleBit.updateSource(source)
@@ -28,6 +28,8 @@ from collections import namedtuple
 
 title = "Git Evolution Scanner"
 version = "0.1.0"
+cpubound = True # Can be run in a worker process (--workers-mode process)
+dependencies = ['git-sync', 'git-sloc'] # Both check out trees in the same working copy
 
 def accepts(source):
     """ Do we accept this source? """
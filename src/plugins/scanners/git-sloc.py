@@ -27,6 +27,7 @@ import re
 
 title = "SloC Counter for Git"
 version = "0.1.1"
+dependencies = ['git-sync']
 
 def accepts(source):
     """ Do we accept this source? """
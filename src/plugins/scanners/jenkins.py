@@ -21,12 +21,13 @@ import re
 import json
 import hashlib
 
-import threading
 import requests.exceptions
 import os
 import urllib.parse
 
 from plugins.utils import jsonapi
+from plugins.utils import asyncengine
+import plugins.utils.concurrency
 
 
 """
@@ -43,36 +44,40 @@ def accepts(source):
     return False
 
 
-def scanJob(KibbleBit, source, job, creds):
-    """ Scans a single job for activity """
-    NOW = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+def jobURL(job):
+    """ Returns the job's name and its build list URL """
     jname = job['name']
     if job.get('folder'):
         jname = job.get('folder') + '-' + job['name']
-    dhash = hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceURL'], jname) )
-                            .encode('ascii', errors='replace')).hexdigest()
-    found = True
-    doc= None
-    parseIt = False
-    found = KibbleBit.exists('cijob', dhash)
-
     # Get $jenkins/job/$job-name/json...
-    jobURL = "%s/api/json?depth=2&tree=builds[number,status,timestamp,id,result,duration]" % job['fullURL']
-    KibbleBit.pprint(jobURL)
+    return jname, "%s/api/json?depth=2&tree=builds[number,status,timestamp,id,result,duration]" % job['fullURL']
 
-    jobjson = jsonapi.get(jobURL, auth = creds)
+async def scanJobAsync(KibbleBit, source, job, creds):
+    """ Scans a single job for activity """
+    jname, jURL = jobURL(job)
+    KibbleBit.pprint(jURL)
+    jobjson = await jsonapi.aget(jURL, auth = creds)
+    return await asyncengine.blocking(parseJob, KibbleBit, source, jname, jURL, jobjson)
 
+def parseJob(KibbleBit, source, jname, jobURL, jobjson):
+    """ Parses the build list of a job """
+    NOW = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
     # If valid JSON, ...
     if jobjson:
         print("jobjson builds: %s" %( jobjson))
+        builds = []
         for build in jobjson.get('builds', []):
             buildhash = hashlib.sha224( ("%s-%s-%s-%s" % (source['organisation'], source['sourceURL'], jname, build['id']) )
                                         .encode('ascii', errors='replace')).hexdigest()
-            builddoc = None
-            try:
-                builddoc = KibbleBit.get('ci_build', buildhash)
-            except:
-                pass
+            builds.append((buildhash, build))
+        # Look up the builds we already have in one go
+        known = {}
+        try:
+            known = KibbleBit.get_many('ci_build', [buildhash for buildhash, build in builds], ['completed', 'queuetime'])
+        except:
+            pass
+        for buildhash, build in builds:
+            builddoc = known.get(buildhash)
 
             # If this build already completed, no need to parse it again
             if builddoc and builddoc.get('completed', False):
@@ -133,67 +138,31 @@ def scanJob(KibbleBit, source, job, creds):
     return False
 
 
-class jenkinsThread(threading.Thread):
-    """ Generic thread class for scheduling multiple scans at once """
-    def __init__(self, block, KibbleBit, source, creds, jobs):
-        super(jenkinsThread, self).__init__()
-        self.block = block
-        self.KibbleBit = KibbleBit
-        self.creds = creds
-        self.source = source
-        self.jobs = jobs
-
-    def run(self):
-        badOnes = 0
-        while len(self.jobs) > 0 and badOnes <= 50:
-            self.block.acquire()
-            try:
-                job = self.jobs.pop(0)
-            except Exception as err:
-                self.block.release()
-                return
-            if not job:
-                self.block.release()
-                return
-            self.block.release()
-            jfolder = job.get('folder')
-            ssource = dict(self.source)
-            if jfolder:
-                ssource['sourceURL'] += '/job/' + jfolder
-            if not scanJob(self.KibbleBit, ssource, job, self.creds):
-                self.KibbleBit.pprint("[%s] This borked, trying another one" % job['name'])
-                badOnes += 1
-                if badOnes > 100:
-                    self.KibbleBit.pprint("Too many errors, bailing!")
-                    self.source['steps']['issues'] = {
-                        'time': time.time(),
-                        'status': 'Too many errors while parsing at '
-                                  + time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(time.time())),
-                        'running': False,
-                        'good': False
-                    }
-                    self.KibbleBit.updateSource(self.source)
-                    return
-            else:
-                badOnes = 0
+def jobSource(source, job):
+    """ Returns the source object to use for a job, which differs for folders """
+    ssource = dict(source)
+    if job.get('folder'):
+        ssource['sourceURL'] += '/job/' + job['folder']
+    return ssource
 
-def scan(KibbleBit, source, filter=None):
+def prepare(KibbleBit, source, filter=None):
+    """ Marks the scan as started, snapshots the queue and fetches the job
+        list. Returns (creds, jobs), or None if this isn't a Jenkins URL. """
     # Simple URL check
     jenkins = re.match(r"(https?://.+)", source['sourceURL'])
     if jenkins:
         if not 'steps' in source:
             source['steps'] = {}
+        badOnes = 0
+        pendingJobs = []
+        KibbleBit.pprint("Parsing Jenkins activity at %s" % source['sourceURL'])
+        # The jenkins step is what shows a Jenkins scan as running
         source['steps']['jenkins'] = {
             'time': time.time(),
             'status': 'Parsing Jenkins job changes...',
             'running': True,
             'good': True
         }
-        KibbleBit.updateSource(source)
-
-        badOnes = 0
-        pendingJobs = []
-        KibbleBit.pprint("Parsing Jenkins activity at %s" % source['sourceURL'])
         source['steps']['issues'] = {
             'time': time.time(),
             'status': 'Downloading changeset',
@@ -271,29 +240,49 @@ def scan(KibbleBit, source, filter=None):
 
         pendingJobs = actual_jobs
         KibbleBit.pprint("Found %u jobs in Jenkins" % len(pendingJobs))
+        return creds, pendingJobs
+    return None
+
+def finish(KibbleBit, source, filter=None):
+    """ Marks the scan as done """
+    # We're all done, yaay
+    KibbleBit.pprint("Done scanning %s" % source['sourceURL'])
+
+    partial = "(filtered) " if filter else ''
+    source['steps']['issues'] = {
+        'time': time.time(),
+        'status': 'Jenkins successfully '+ partial+'scanned at ' + time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(time.time())),
+        'running': False,
+        'good': True
+    }
+    source['steps']['jenkins'] = dict(source['steps']['issues'])
+    KibbleBit.updateSource(source)
 
-        threads = []
-        block = threading.Lock()
-        KibbleBit.pprint("Scanning jobs using 4 sub-threads")
-        for i in range(0,4):
-            t = jenkinsThread(block, KibbleBit, source, creds, pendingJobs)
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        # We're all done, yaay
-        KibbleBit.pprint("Done scanning %s" % source['sourceURL'])
-
-        partial = "(filtered) " if filter else ''
-        source['steps']['issues'] = {
-            'time': time.time(),
-            'status': 'Jenkins successfully '+ partial+'scanned at ' + time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(time.time())),
-            'running': False,
-            'good': True
-        }
-        KibbleBit.updateSource(source)
+def scan(KibbleBit, source, filter=None):
+    """ Scans a Jenkins instance, on the async engine """
+    asyncengine.run(scan_async(KibbleBit, source, filter))
+
+async def scan_async(KibbleBit, source, filter=None):
+    """ Scans a Jenkins instance: all jobs are fetched on the async engine,
+        with up to scanner.concurrency.inflight requests in flight. The
+        core always runs this one; scan() is there for direct callers. """
+    prep = await asyncengine.blocking(prepare, KibbleBit, source, filter)
+    if prep:
+        creds, pendingJobs = prep
+
+        async def scanOne(job):
+            try:
+                return await scanJobAsync(KibbleBit, jobSource(source, job), job, creds)
+            except Exception as err:
+                KibbleBit.pprint("[%s] This borked: %s" % (job['name'], err))
+                return False
+
+        inflight = plugins.utils.concurrency.inflight('jenkins', source['sourceURL'])
+        KibbleBit.pprint("Scanning jobs with up to %u requests in flight" % inflight)
+        results = await asyncengine.gather(pendingJobs, scanOne, inflight)
+        if results.count(False):
+            KibbleBit.pprint("%u jobs could not be scanned" % results.count(False))
+        await asyncengine.blocking(finish, KibbleBit, source, filter)
 
 def get_all_jobs(KibbleBit, source, joblist, job_filter, creds):
     real_jobs = []
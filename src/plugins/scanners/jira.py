@@ -22,6 +22,7 @@ import json
 import hashlib
 import threading
 import requests.exceptions
+import plugins.utils.concurrency
 
 """
 This is the Kibble JIRA scanner plugin.
@@ -103,10 +104,15 @@ def pchange(js):
     return False
 
 
-def scanTicket(KibbleBit, key, u, source, creds, openTickets):
-    """ Scans a single ticket for activity and people """
+def ticketHash(source, key):
+    """ Returns the document ID of a ticket """
+    return hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceURL'], key) ).encode('ascii', errors='replace')).hexdigest()
 
-    dhash = hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceURL'], key) ).encode('ascii', errors='replace')).hexdigest()
+def scanTicket(KibbleBit, key, u, source, creds, openTickets, known = None):
+    """ Scans a single ticket for activity and people. known, if given,
+        holds the tickets we've already got, looked up in bulk. """
+
+    dhash = ticketHash(source, key)
     found = True
     doc= None
     parseIt = False
@@ -119,12 +125,16 @@ def scanTicket(KibbleBit, key, u, source, creds, openTickets):
     if m:
         domain = m.group(1)
 
-    found = KibbleBit.exists('issue', dhash)
+    if known is not None:
+        ticket = known.get(dhash)
+        found = ticket is not None
+    else:
+        found = KibbleBit.exists('issue', dhash)
+        ticket = KibbleBit.get('issue', dhash) if found else None
     if not found:
         KibbleBit.pprint("[%s] We've never seen this ticket before, parsing..." % key)
         parseIt = True
     else:
-        ticket = KibbleBit.get('issue', dhash)
         if ticket['status'] == 'closed' and key in openTickets:
             KibbleBit.pprint("[%s] Ticket was reopened, reparsing" % key)
             parseIt = True
@@ -239,7 +249,7 @@ def scanTicket(KibbleBit, key, u, source, creds, openTickets):
 
 class jiraThread(threading.Thread):
 
-    def __init__(self, block, KibbleBit, source, creds, pt, ot):
+    def __init__(self, block, KibbleBit, source, creds, pt, ot, known = None):
         super(jiraThread, self).__init__()
         self.block = block
         self.KibbleBit = KibbleBit
@@ -247,6 +257,7 @@ class jiraThread(threading.Thread):
         self.source = source
         self.pendingTickets = pt
         self.openTickets = ot
+        self.known = known
 
     def run(self):
         badOnes = 0
@@ -262,7 +273,7 @@ class jiraThread(threading.Thread):
                 self.block.release()
                 return
             self.block.release()
-            if not scanTicket(self.KibbleBit, rl[0], rl[1], rl[2], self.creds, self.openTickets):
+            if not scanTicket(self.KibbleBit, rl[0], rl[1], rl[2], self.creds, self.openTickets, self.known):
                 self.KibbleBit.pprint("[%s] This borked, trying another one" % rl[0])
                 badOnes += 1
                 if badOnes > 100:
@@ -301,14 +312,6 @@ def scan(KibbleBit, source):
             KibbleBit.updateSource(source)
             return
 
-        source['steps']['issues'] = {
-            'time': time.time(),
-            'status': 'Parsing JIRA changes...',
-            'running': True,
-            'good': True
-        }
-        KibbleBit.updateSource(source)
-
         badOnes = 0
         jsa = []
         jsp = []
@@ -373,11 +376,18 @@ def scan(KibbleBit, source):
             key = "%s-%u" % (instance, i)
             pendingTickets.append([key, u, source])
 
+        # Look up the tickets we already have in one go, rather than
+        # one request per ticket.
+        KibbleBit.pprint("Looking up which of the %u tickets we already have" % len(pendingTickets))
+        known = KibbleBit.get_many('issue', [ticketHash(source, item[0]) for item in pendingTickets],
+                                   ['status', 'issueCreator', 'issueCloser'])
+
         threads = []
         block = threading.Lock()
-        KibbleBit.pprint("Scanning tickets using 4 sub-threads")
-        for i in range(0,4):
-            t = jiraThread(block, KibbleBit, source, creds, pendingTickets, openTickets)
+        threadCount = plugins.utils.concurrency.threads('jira', u)
+        KibbleBit.pprint("Scanning tickets using %u sub-threads" % threadCount)
+        for i in range(0,threadCount):
+            t = jiraThread(block, KibbleBit, source, creds, pendingTickets, openTickets, known)
             threads.append(t)
             t.start()
 
@@ -29,6 +29,7 @@ import plugins.utils.urlmisc
 
 title = "Scanner for GNU Mailman Pipermail"
 version = "0.1.0"
+cpubound = True # Can be run in a worker process (--workers-mode process)
 
 def accepts(source):
     """ Whether or not we think this is pipermail """
@@ -30,6 +30,7 @@ import plugins.utils.tone
 
 title = "Tone/Mood Scanner plugin for Apache Pony Mail"
 version = "0.1.0"
+dependencies = ['ponymail'] # Analyses the emails ponymail has stored
 ROBITS = r"(git|gerrit|jenkins|hudson|builds|bugzilla)@"
 MAX_COUNT = 250
 
@@ -87,12 +88,7 @@ def scan(KibbleBit, source):
         }
         
     # Get an initial count of commits
-    res = KibbleBit.broker.DB.search(
-        index=KibbleBit.dbname,
-        doc_type="email",
-        body = query,
-        size = MAX_COUNT * 4
-    )
+    res = KibbleBit.search("email", query, size = MAX_COUNT * 4)
     ec = 0
     hits = []
     for hit in res['hits']['hits']:
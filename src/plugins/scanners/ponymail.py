@@ -200,6 +200,15 @@ def scan(KibbleBit, source):
                 }
                 KibbleBit.index('mailtop', mlhash, jst)
 
+            # Look up the senders we haven't seen yet in one go
+            unknowns = {}
+            for email in js['emails']:
+                sender = getSender(email)
+                if not sender in knowns:
+                    unknowns[hashlib.sha1( ("%s%s" % (source['organisation'], sender)).encode('ascii', errors='replace')).hexdigest()] = sender
+            for sid in KibbleBit.exists_many('person', unknowns.keys()):
+                knowns[unknowns[sid]] = True
+
             for email in js['emails']:
                 sender = email['from']
                 name = sender
@@ -212,10 +221,6 @@ def scan(KibbleBit, source):
                         'name': name,
                         'email': sender
                     }
-                if not sender in knowns:
-                    sid = hashlib.sha1( ("%s%s" % (source['organisation'], sender)).encode('ascii', errors='replace')).hexdigest()
-                    if KibbleBit.exists('person',sid):
-                        knowns[sender] = True
                 if not sender in knowns or name != sender:
                     KibbleBit.append('person',
                         {
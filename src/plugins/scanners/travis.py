@@ -23,6 +23,7 @@ import hashlib
 import threading
 import requests
 import requests.exceptions
+import plugins.utils.concurrency
 import os
 
 """
@@ -42,11 +43,6 @@ def accepts(source):
 def scanJob(KibbleBit, source, bid, token, TLD):
     """ Scans a single job for activity """
     NOW = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-    dhash = hashlib.sha224( ("%s-%s-%s" % (source['organisation'], source['sourceURL'], bid) ).encode('ascii', errors='replace')).hexdigest()
-    found = True
-    doc= None
-    parseIt = False
-    found = KibbleBit.exists('cijob', dhash)
 
     # Get the job data
     pages = 0
@@ -58,7 +54,8 @@ def scanJob(KibbleBit, source, bid, token, TLD):
     while last_page == False:
         bURL = "https://api.travis-ci.%s/repo/%s/builds?limit=100&offset=%u" % (TLD, bid, offset)
         KibbleBit.pprint("Scanning %s" % bURL)
-        rv = requests.get(bURL, headers = {'Travis-API-Version': '3', 'Authorization': "token %s" % token})
+        with plugins.utils.concurrency.host(bURL):
+            rv = requests.get(bURL, headers = {'Travis-API-Version': '3', 'Authorization': "token %s" % token})
         if rv.status_code == 200:
             repojs = rv.json()
             # If travis tells us it's the last page, trust it.
@@ -73,6 +70,13 @@ def scanJob(KibbleBit, source, bid, token, TLD):
                 return True
 
             offset += 100
+            # Look up the builds on this page we already have in one go
+            known = {}
+            try:
+                known = KibbleBit.get_many('ci_build', [hashlib.sha224( ("%s-%s-%s-%s" % (source['organisation'], source['sourceURL'], bid, build['id']) ).encode('ascii', errors='replace')).hexdigest()
+                                                        for build in repojs.get('builds', [])], ['completed'])
+            except:
+                pass
             for build in repojs.get('builds', []):
                 buildID = build['id']
                 buildProject = build['repository']['slug']
@@ -84,11 +88,7 @@ def scanJob(KibbleBit, source, bid, token, TLD):
 
 
                 buildhash = hashlib.sha224( ("%s-%s-%s-%s" % (source['organisation'], source['sourceURL'], bid, buildID) ).encode('ascii', errors='replace')).hexdigest()
-                builddoc = None
-                try:
-                    builddoc = KibbleBit.get('ci_build', buildhash)
-                except:
-                    pass
+                builddoc = known.get(buildhash)
 
                 # If this build already completed, no need to parse it again
                 if builddoc and builddoc.get('completed', False):
@@ -240,7 +240,8 @@ def scan(KibbleBit, source):
         while jobs == 100:
             URL = "https://api.travis-ci.%s/repos?repository.active=true&sort_by=current_build:desc&offset=%u&limit=100&include=repository.last_started_build" % (TLD, offset)
             offset += 100
-            r = requests.get(URL, headers = {'Travis-API-Version': '3', 'Authorization': "token %s" % token})
+            with plugins.utils.concurrency.host(URL):
+                r = requests.get(URL, headers = {'Travis-API-Version': '3', 'Authorization': "token %s" % token})
 
             if r.status_code != 200:
                 KibbleBit.pprint("Travis did not return a 200 Okay, bad token?!")
@@ -277,7 +278,8 @@ def scan(KibbleBit, source):
         # Find out how many building and pending jobs
         for jobID in maybeQueued:
             URL = "https://api.travis-ci.%s/job/%u" % (TLD, jobID)
-            r = requests.get(URL, headers = {'Travis-API-Version': '3', 'Authorization': "token %s" % token})
+            with plugins.utils.concurrency.host(URL):
+                r = requests.get(URL, headers = {'Travis-API-Version': '3', 'Authorization': "token %s" % token})
             if r.status_code == 200:
                 jobjs = r.json()
                 if jobjs['state'] == 'started':
@@ -317,8 +319,9 @@ def scan(KibbleBit, source):
 
         threads = []
         block = threading.Lock()
-        KibbleBit.pprint("Scanning jobs using 4 sub-threads")
-        for i in range(0,4):
+        threadCount = plugins.utils.concurrency.threads('travis', "https://api.travis-ci.%s/" % TLD)
+        KibbleBit.pprint("Scanning jobs using %u sub-threads" % threadCount)
+        for i in range(0,threadCount):
             t = travisThread(block, KibbleBit, source, token, pendingJobs, TLD)
             threads.append(t)
             t.start()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble asyncio engine utility plugin.
+Scanners that provide an `async def scan_async(KibbleBit, source)`
+entry point get run on a single, shared event loop, so HTTP-bound
+plugins can keep many requests in flight without a thread per request.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+LOOP = None
+LOOP_LOCK = threading.Lock()
+EXECUTOR = None # For blocking calls (ES lookups etc) made from coroutines
+CLEANUPS = [] # Coroutine functions to run on shutdown (closing sessions etc)
+BLOCKING_THREADS = 8
+
+def loop():
+    """ Returns the engine's event loop, starting it if need be """
+    global LOOP, EXECUTOR
+    with LOOP_LOCK:
+        if LOOP is None:
+            LOOP = asyncio.new_event_loop()
+            EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers = BLOCKING_THREADS)
+            LOOP.set_default_executor(EXECUTOR)
+            t = threading.Thread(target = LOOP.run_forever, name = "asyncengine", daemon = True)
+            t.start()
+        return LOOP
+
+def run(coro):
+    """ Runs a coroutine on the engine and waits for its result.
+        Safe to call from any number of scan threads at once. """
+    return asyncio.run_coroutine_threadsafe(coro, loop()).result()
+
+async def blocking(fn, *args, **kwargs):
+    """ Runs a blocking function (e.g. a KibbleBit call) off the event loop """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+async def gather(items, fn, limit):
+    """ Runs fn(item) for every item, with at most limit running at once.
+        Returns the list of results, in order. """
+    sem = asyncio.Semaphore(limit)
+    async def bounded(item):
+        async with sem:
+            return await fn(item)
+    return await asyncio.gather(*[bounded(item) for item in items])
+
+def onShutdown(fn):
+    """ Registers a coroutine function to be awaited when the engine shuts down """
+    CLEANUPS.append(fn)
+
+def shutdown():
+    """ Runs the cleanup hooks and stops the engine, if it was ever started """
+    global LOOP, EXECUTOR
+    with LOOP_LOCK:
+        if LOOP is None:
+            return
+    for fn in CLEANUPS:
+        run(fn())
+    del CLEANUPS[:]
+    with LOOP_LOCK:
+        LOOP.call_soon_threadsafe(LOOP.stop)
+        EXECUTOR.shutdown(wait = True)
+        LOOP = None
+        EXECUTOR = None
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble node balancing utility plugin.
+Sources are spread across scanner nodes using (weighted) rendezvous
+hashing: every node scores every source, and the highest score wins.
+When a node joins or leaves the cluster, only the sources it wins or
+loses change hands, so git clones in the scratch dirs stay put.
+"""
+
+import hashlib
+import math
+import sys
+import threading
+
+LEASE_TTL = 3600 # Default seconds before a scan lease runs out
+
+def nodes(config):
+    """ Returns (nodeNo, numNodes) from the scanner.balance setting, or None """
+    if config['scanner'].get('balance',  None):
+        a = config['scanner']['balance'].split('/')
+        nodeNo = int(a[0])
+        numNodes = int(a[1])
+        if numNodes == 0:
+            return None
+        return nodeNo, numNodes
+    return None
+
+def weight(config, node):
+    """ Relative weight of a node (scanner.weights), defaults to 1 """
+    weights = config['scanner'].get('weights')
+    if isinstance(weights, dict):
+        return float(weights.get(node, 1))
+    if isinstance(weights, list) and node <= len(weights):
+        return float(weights[node-1])
+    return 1.0
+
+def score(ID, node, w):
+    """ Rendezvous score of a node for a source """
+    h = hashlib.sha1(("%s:%s" % (node, ID)).encode('ascii', errors='replace')).digest()
+    # Map the hash to (0,1), open on both ends
+    x = (int.from_bytes(h[:8], 'big') + 0.5) / 2**64
+    return -w / math.log(x)
+
+def owner(ID, numNodes, config):
+    """ Returns the node number (1-based) that owns a source """
+    best = None
+    bestScore = None
+    for node in range(1, numNodes+1):
+        s = score(ID, node, weight(config, node))
+        if best is None or s > bestScore:
+            best = node
+            bestScore = s
+    return best
+
+def isMine(ID, config):
+    """ Whether a source belongs to this node """
+    n = nodes(config)
+    if not n:
+        return True
+    nodeNo, numNodes = n
+    return owner(ID, numNodes, config) == nodeNo
+
+def stealing(config):
+    """ Whether work stealing (scanner.steal) is enabled """
+    return bool(nodes(config) and config['scanner'].get('steal', False))
+
+def nodeName(config):
+    """ The name this node goes by in lease documents """
+    n = nodes(config)
+    return "node-%u" % n[0] if n else "node-1"
+
+class Leases:
+    """ The scan leases this node holds, for work stealing. A heartbeat
+        thread renews them every third of their lifetime, so a scan that
+        runs for longer than that doesn't look abandoned to other nodes. """
+
+    def __init__(self, broker, config):
+        self.broker = broker
+        self.node = nodeName(config)
+        self.ttl = int(config['scanner'].get('lease', LEASE_TTL))
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+
+    def acquire(self, sourceID, since):
+        """ Tries to take the lease on a source, see Broker.acquireLease """
+        with self.lock:
+            if not self.broker.acquireLease(sourceID, self.node, self.ttl, since):
+                return False
+            self.held.add(sourceID)
+            if not self.thread:
+                self.thread = threading.Thread(target = self.heartbeat, name = "leases", daemon = True)
+                self.thread.start()
+            return True
+
+    def release(self, sourceID):
+        """ Lets go of a lease, if it is still ours """
+        with self.lock:
+            self.held.discard(sourceID)
+            if not self.broker.releaseLease(sourceID, self.node):
+                sys.stderr.write("[core]: Lease on %s was taken over by another node before we were done\n" % sourceID)
+
+    def heartbeat(self):
+        while not self.stop.wait(max(1, self.ttl / 3)):
+            with self.lock:
+                for sourceID in list(self.held):
+                    try:
+                        if not self.broker.renewLease(sourceID, self.node, self.ttl):
+                            sys.stderr.write("[core]: Lost the lease on %s to another node\n" % sourceID)
+                            self.held.discard(sourceID)
+                    except Exception as err:
+                        # Try again on the next beat, there's time left
+                        sys.stderr.write("[core]: Could not renew the lease on %s: %s\n" % (sourceID, err))
+
+    def close(self):
+        """ Stops the heartbeat """
+        self.stop.set()
+        if self.thread:
+            self.thread.join()
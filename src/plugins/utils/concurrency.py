@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble concurrency limits utility plugin.
+It reads the scanner.concurrency section of the config and tells the
+core and the threaded plugins how many workers they may use, and keeps
+a semaphore per remote host to cap the number of requests in flight.
+
+    scanner:
+        concurrency:
+            workers:      8     # Core scan threads
+            processes:    16    # Worker processes for --workers-mode process
+            threads:      4     # Default sub-threads per plugin scan
+            inflight:     64    # Default requests in flight per async plugin scan
+            organisation: 2     # Max core workers per organisation
+            plugins:
+                jenkins:  64
+            hosts:
+                issues.apache.org: 2
+"""
+
+import asyncio
+import multiprocessing
+import threading
+import urllib.parse
+
+DEFAULT_THREADS = 4 # Sub-threads per plugin scan if nothing is configured
+DEFAULT_INFLIGHT = 64 # Requests in flight per async plugin scan if nothing is configured
+SLOT_POLL = 0.05 # Seconds between tries when a coroutine waits for a host slot
+CONFIG = {}
+HOSTS = {}
+HOSTS_LOCK = threading.Lock()
+
+class NoLimit:
+    """ Stand-in for a semaphore on hosts without a limit """
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *args):
+        return False
+
+class AsyncSlot:
+    """ Holds a slot of a host's semaphore from a coroutine. Threads and
+        the async engine share the one semaphore, so a host never gets
+        more than its limit; we wait without blocking the event loop. """
+    def __init__(self, sem):
+        self.sem = sem
+    async def __aenter__(self):
+        while not self.sem.acquire(blocking = False):
+            await asyncio.sleep(SLOT_POLL)
+        return self
+    async def __aexit__(self, *args):
+        self.sem.release()
+        return False
+
+def configure(config):
+    """ Loads the concurrency settings from the main config """
+    global CONFIG
+    CONFIG = config.get('scanner', {}).get('concurrency') or {}
+    with HOSTS_LOCK:
+        HOSTS.clear()
+
+def workers():
+    """ Number of core scan threads. Defaults to the number of cores
+        on the box, but no more than 4. We don't want an IOWait nightmare. """
+    return int(CONFIG.get('workers', min(4, multiprocessing.cpu_count())))
+
+def processes():
+    """ Number of worker processes for CPU-bound scanners """
+    return int(CONFIG.get('processes', multiprocessing.cpu_count()))
+
+def hostname(url):
+    """ Returns the host part of a URL, or None """
+    if not url:
+        return None
+    return urllib.parse.urlparse(url).hostname
+
+def hostLimit(url):
+    """ Max concurrent requests allowed against the host of a URL, 0 for no limit """
+    hosts = CONFIG.get('hosts') or {}
+    return int(hosts.get(hostname(url), 0))
+
+def threads(plugin, url = None):
+    """ Number of sub-threads a plugin may use for scanning a source at url """
+    plugins = CONFIG.get('plugins') or {}
+    n = int(plugins.get(plugin, CONFIG.get('threads', DEFAULT_THREADS)))
+    limit = hostLimit(url)
+    if limit:
+        n = min(n, limit)
+    return max(1, n)
+
+def host(url):
+    """ Returns a context manager that holds one of the request slots
+        for the host of a URL. Hosts without a limit are not throttled. """
+    limit = hostLimit(url)
+    if not limit:
+        return NoLimit()
+    name = hostname(url)
+    with HOSTS_LOCK:
+        if name not in HOSTS:
+            HOSTS[name] = threading.BoundedSemaphore(limit)
+        return HOSTS[name]
+
+def inflight(plugin, url = None):
+    """ Number of requests an async plugin scan may have in flight """
+    plugins = CONFIG.get('plugins') or {}
+    n = int(plugins.get(plugin, CONFIG.get('inflight', DEFAULT_INFLIGHT)))
+    limit = hostLimit(url)
+    if limit:
+        n = min(n, limit)
+    return max(1, n)
+
+def asyncHost(url):
+    """ Same as host(), but for coroutines running on the async engine.
+        The slots are the same ones the threaded scanners use. """
+    sem = host(url)
+    if isinstance(sem, NoLimit):
+        return sem
+    return AsyncSlot(sem)
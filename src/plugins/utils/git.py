@@ -17,9 +17,18 @@
 
 """ This is the Kibble git utility plugin """
 
+import concurrent.futures
+import itertools
+import queue
 import subprocess
+import threading
 import re
 
+READ_SIZE = 1024 * 1024 # Bytes to read from git at a time when streaming
+FIELD_SEP = "\x1f" # Separates the fields of a commit header, unlike | it can't be in a name
+LOG_FORMAT = "--pretty=format:%H%x1f%ce%x1f%cn%x1f%ae%x1f%an%x1f%ct"
+CHUNK_SIZE = 2000 # Commits per chunk when reading a log in parallel
+
 def defaultBranch(source, datapath, KibbleBit = None):
     """ Tries to figure out what the main branch of a repo is """
     wanted_branches = ['main', 'master', 'trunk']
@@ -60,3 +69,218 @@ def defaultBranch(source, datapath, KibbleBit = None):
                 return branch
     # Give up
     return ""
+
+def tokens(stream):
+    """ Splits a stream of NUL-delimited git output into strings, without
+        ever holding more than a chunk of it in memory """
+    buf = b''
+    while True:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        parts = (buf + chunk).split(b'\0')
+        buf = parts.pop()
+        for part in parts:
+            yield part.decode('utf-8', errors = 'replace')
+    if buf:
+        yield buf.decode('utf-8', errors = 'replace')
+
+def commits(stream):
+    """ Parses `git log -z --numstat` output in LOG_FORMAT, one commit at
+        a time. Each commit is a header line, glued to the first numstat
+        entry, then one NUL-terminated entry per file, then an extra NUL.
+        Renames have an empty path, followed by the old and new paths.
+        Commits without files (merges, empty ones) are just the header. """
+    commit = None
+    rename = None
+    for token in tokens(stream):
+        if rename is not None:
+            # Old path, then new path; the new one is what counts
+            rename.append(token)
+            if len(rename) == 4:
+                commit[6].append((rename[0], rename[1], rename[3]))
+                rename = None
+            continue
+        if commit is not None and token == '':
+            yield commit
+            commit = None
+            continue
+        if commit is None:
+            header, nl, token = token.partition("\n")
+            fields = header.split(FIELD_SEP)
+            if len(fields) != 6 or not fields[5].isdigit():
+                continue
+            commit = (fields[0], fields[1], fields[2], fields[3], fields[4], int(fields[5]), [])
+            if not nl:
+                yield commit
+                commit = None
+                continue
+        insert, delete, filename = (token.split("\t", 2) + ['', ''])[:3]
+        # Binary files have - for a line count
+        insert = int(insert) if insert.isdigit() else None
+        delete = int(delete) if delete.isdigit() else None
+        if filename:
+            commit[6].append((insert, delete, filename))
+        else:
+            rename = [insert, delete]
+    if commit is not None:
+        yield commit
+
+def log(gitdir, *args, revisions = None):
+    """ Streams the history of a repository, one commit at a time, as
+        (hash, committer email, committer name, author email, author name,
+        commit time, files) with files a list of (insertions, deletions,
+        filename). Insertions and deletions are None for binary files.
+        Any extra args (--all, --after=..., revisions) go to git log.
+        A (long) list of revisions, such as ^hash to leave out, can be
+        passed through stdin instead of the command line. """
+    cmd = ['git', '--git-dir', gitdir, 'log', '-z', '--numstat', LOG_FORMAT] + list(args)
+    if revisions is not None:
+        cmd.append('--stdin')
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stdin = subprocess.PIPE if revisions is not None else None)
+    if revisions is not None:
+        # git reads all of these before it starts writing, so this can't deadlock
+        proc.stdin.write("".join("%s\n" % rev for rev in revisions).encode('ascii', errors = 'replace'))
+        proc.stdin.close()
+    try:
+        for commit in commits(proc.stdout):
+            yield commit
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+
+def revList(gitdir, *args, revisions = None):
+    """ Streams the hashes of the commits git log would show for the
+        same args and revisions, without the (slow) diffs """
+    cmd = ['git', '--git-dir', gitdir, 'rev-list'] + list(args)
+    if revisions is not None:
+        cmd.append('--stdin')
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stdin = subprocess.PIPE if revisions is not None else None)
+    if revisions is not None:
+        proc.stdin.write("".join("%s\n" % rev for rev in revisions).encode('ascii', errors = 'replace'))
+        proc.stdin.close()
+    try:
+        for line in proc.stdout:
+            yield line.decode('ascii', 'replace').strip()
+    finally:
+        proc.stdout.close()
+        rc = proc.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+
+def parallelLog(gitdir, *args, revisions = None, workers = 1):
+    """ Same as log(), but for big histories the commits are split into
+        chunks that several git processes work on at once; working out
+        the diffs is what takes git the most time. Commits come out in no
+        particular order. The list of commits is read as a stream, and
+        only a few chunks are held at a time. """
+    if workers <= 1:
+        yield from log(gitdir, *args, revisions = revisions)
+        return
+    hashes = revList(gitdir, *args, revisions = revisions)
+    first = list(itertools.islice(hashes, CHUNK_SIZE))
+    second = list(itertools.islice(hashes, CHUNK_SIZE))
+    if not second:
+        hashes.close()
+        # An empty --stdin list would make git fall back to HEAD
+        if first:
+            yield from log(gitdir, '--no-walk=unsorted', revisions = first)
+        return
+    done = object()
+    results = queue.Queue(1000)
+    stop = threading.Event()
+    slots = threading.Semaphore(workers * 2) # Chunks read ahead of the git processes
+    futures = []
+    def readChunk(chunk):
+        try:
+            if stop.is_set():
+                return
+            for commit in log(gitdir, '--no-walk=unsorted', revisions = chunk):
+                if stop.is_set():
+                    break
+                results.put(commit)
+            results.put(done)
+        except Exception as err:
+            results.put(err)
+        finally:
+            slots.release()
+    def feed(pool):
+        """ Hands out chunks as rev-list fills them up, then says how many there were """
+        chunks = 0
+        try:
+            for chunk in itertools.chain([first, second], iter(lambda: list(itertools.islice(hashes, CHUNK_SIZE)), [])):
+                while not slots.acquire(timeout = 0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                futures.append(pool.submit(readChunk, chunk))
+                chunks += 1
+            results.put(chunks)
+        except Exception as err:
+            results.put(err)
+        finally:
+            hashes.close()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as pool:
+        feeder = threading.Thread(target = feed, args = (pool,), name = "revlist", daemon = True)
+        feeder.start()
+        try:
+            total = None
+            finished = 0
+            while total is None or finished < total:
+                item = results.get()
+                if item is done:
+                    finished += 1
+                elif isinstance(item, int):
+                    total = item
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # Let the feeder and readers run out if we stop early (or fail)
+            stop.set()
+            while feeder.is_alive() or not all(future.done() for future in list(futures)):
+                try:
+                    results.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+
+def tips(gitdir):
+    """ Returns the set of commits that the refs (and HEAD) of a
+        repository point at, i.e. what `git log --all` starts from.
+        Tags of trees or blobs don't lead to any commits, and are left out. """
+    out = subprocess.check_output(['git', '--git-dir', gitdir, 'for-each-ref', '--format=%(objectname)'])
+    refs = set(out.decode('ascii', 'replace').split())
+    # Peel annotated tags (even tags of tags) down to what they point at
+    commits = set(obj for obj, kind in objectTypes(gitdir, refs, peel = True).items() if kind == 'commit')
+    try:
+        commits.add(subprocess.check_output(['git', '--git-dir', gitdir, 'rev-parse', '-q', '--verify', 'HEAD^{commit}'], stderr = subprocess.DEVNULL).decode('ascii', 'replace').strip())
+    except subprocess.CalledProcessError:
+        pass # Empty repository
+    return commits
+
+def objectTypes(gitdir, objects, peel = False):
+    """ Looks up the type (commit, tree, blob or tag) of objects in a
+        repository, None for the ones that don't exist. With peel, tags
+        are followed to the object they end up at, and the dict maps
+        that object to its type instead. """
+    objects = list(objects)
+    suffix = "^{}" if peel else ""
+    out = subprocess.run(['git', '--git-dir', gitdir, 'cat-file', '--batch-check'], stdout = subprocess.PIPE, check = True,
+                         input = "".join("%s%s\n" % (obj, suffix) for obj in objects).encode('ascii', errors = 'replace')).stdout
+    types = {}
+    for obj, line in zip(objects, out.decode('ascii', 'replace').split("\n")):
+        parts = line.split()
+        if len(parts) == 3:
+            types[parts[0] if peel else obj] = parts[1]
+        elif not peel:
+            types[obj] = None # "<obj> missing"
+    return types
+
+def existing(gitdir, commits):
+    """ Returns the subset of the given commits that exist in a
+        repository. History may have been rewritten since we saw them. """
+    return set(obj for obj, kind in objectTypes(gitdir, commits).items() if kind == 'commit')
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble document ID cache utility plugin.
+It keeps a local SQLite database per organisation of the document IDs
+we know to exist in the database, so incremental scans don't have to
+ask ES about the same documents run after run. Only positive answers
+are cached: an ID that isn't in the cache is looked up as usual. Entries
+expire after a while, so documents deleted from ES are picked up again
+eventually. Documents the scanners have only queued up for ES are held
+in memory as pending, and only written out once they have made it.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_TTL = 7 * 86400 # Seconds before a cached ID (or a warm-up) goes stale
+COMMIT_EVERY = 1000 # New IDs to hold in memory before writing them out
+LOOKUP_SIZE = 500 # IDs per lookup query, SQLite has a cap on variables
+
+class IdCache:
+    """ On-disk cache of known document IDs for one organisation """
+
+    def __init__(self, path, ttl = DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.warmLock = threading.Lock() # Held while loading all IDs of a doctype
+        self.added = set() # (doctype, id) pairs not written out yet
+        self.pending = {} # (doctype, id) -> generation, for documents on their way to ES
+        self.generation = 0
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.db = sqlite3.connect(path, timeout = 30, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ids (doctype TEXT, id TEXT, ts REAL, PRIMARY KEY (doctype, id)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS warm (doctype TEXT PRIMARY KEY, ts REAL)")
+        self.db.commit()
+
+    def has(self, doctype, docid):
+        """ Whether a document is known to exist """
+        return docid in self.known(doctype, [docid])
+
+    def known(self, doctype, docids):
+        """ Returns the subset of docids known to exist """
+        docids = list(docids)
+        since = time.time() - self.ttl
+        found = set()
+        with self.lock:
+            for docid in docids:
+                if (doctype, docid) in self.added or (doctype, docid) in self.pending:
+                    found.add(docid)
+            rest = [docid for docid in docids if docid not in found]
+            for i in range(0, len(rest), LOOKUP_SIZE):
+                chunk = rest[i:i+LOOKUP_SIZE]
+                cur = self.db.execute("SELECT id FROM ids WHERE doctype = ? AND ts > ? AND id IN (%s)" % ",".join("?" * len(chunk)),
+                                      [doctype, since] + chunk)
+                found.update(row[0] for row in cur)
+        return found
+
+    def add(self, doctype, docids):
+        """ Marks documents as existing """
+        with self.lock:
+            for docid in docids:
+                self.added.add((doctype, docid))
+            if len(self.added) >= COMMIT_EVERY:
+                self._commit()
+
+    def pend(self, doctype, docids):
+        """ Notes documents that have been queued up for ES. They count
+            as known right away, but are only written out once confirm()
+            says they've made it, so a crash can't leave them cached. """
+        with self.lock:
+            for docid in docids:
+                self.pending[(doctype, docid)] = self.generation
+
+    def mark(self):
+        """ Returns a marker for the documents pending so far, to pass
+            to confirm() once the writer has flushed them """
+        with self.lock:
+            self.generation += 1
+            return self.generation - 1
+
+    def confirm(self, marker = None):
+        """ Marks pending documents up to a marker (or all of them) as
+            existing """
+        with self.lock:
+            for key, generation in list(self.pending.items()):
+                if marker is None or generation <= marker:
+                    del self.pending[key]
+                    self.added.add(key)
+            if len(self.added) >= COMMIT_EVERY:
+                self._commit()
+
+    def forget(self, doctype, docids):
+        """ Marks documents as not known to exist after all, e.g. when
+            ES turned them down """
+        docids = list(docids)
+        with self.lock:
+            for docid in docids:
+                self.added.discard((doctype, docid))
+                self.pending.pop((doctype, docid), None)
+            self.db.executemany("DELETE FROM ids WHERE doctype = ? AND id = ?", [(doctype, docid) for docid in docids])
+            self.db.commit()
+
+    def isWarm(self, doctype):
+        """ Whether we've loaded all IDs of a doctype lately """
+        with self.lock:
+            row = self.db.execute("SELECT ts FROM warm WHERE doctype = ?", (doctype,)).fetchone()
+            return bool(row and row[0] > time.time() - self.ttl)
+
+    def warmed(self, doctype):
+        """ Notes that all IDs of a doctype have just been loaded """
+        with self.lock:
+            self._commit()
+            self.db.execute("INSERT OR REPLACE INTO warm VALUES (?, ?)", (doctype, time.time()))
+            self.db.commit()
+
+    def commit(self):
+        """ Writes out any new IDs """
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if self.added:
+            now = time.time()
+            self.db.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?)", [(doctype, docid, now) for doctype, docid in self.added])
+            self.db.commit()
+            self.added = set()
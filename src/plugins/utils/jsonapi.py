@@ -23,6 +23,17 @@ import json
 import time
 import re
 import base64
+import asyncio
+import plugins.utils.concurrency
+import plugins.utils.asyncengine
+
+# aiohttp is optional; without it, aget() falls back to running get()
+# in the async engine's thread pool.
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+SESSION = None
 
 CONNECT_TIMEOUT = 2 # Max timeout for the connect part of a request.
                     # Should be set low as it may otherwise freeze the scanner.
@@ -41,7 +52,8 @@ def get(url, cookie = None, auth = None, token = None, retries = 5, timeout = 30
     if cookie:
         headers["Cookie"] = cookie
     # print("fetching url %s" % url)
-    rv = requests.get(url, headers = headers, timeout = (CONNECT_TIMEOUT, timeout))
+    with plugins.utils.concurrency.host(url):
+        rv = requests.get(url, headers = headers, timeout = (CONNECT_TIMEOUT, timeout))
     # Some services may be rate limited. We'll try sleeping it off in 60 second
     # intervals for a max of five minutes, then give up.
     if rv.status_code == 429:
@@ -53,6 +65,46 @@ def get(url, cookie = None, auth = None, token = None, retries = 5, timeout = 30
         return rv.json()
     raise requests.exceptions.ConnectionError("Could not fetch JSON, server responded with status code %u" % rv.status_code, response = rv)
 
+async def aget(url, cookie = None, auth = None, token = None, retries = 5, timeout = 30):
+    """ Same as get(), but as a coroutine for the async engine """
+    if not aiohttp:
+        return await plugins.utils.asyncengine.blocking(get, url, cookie = cookie, auth = auth, token = token, retries = retries, timeout = timeout)
+    global SESSION
+    if SESSION is None:
+        SESSION = aiohttp.ClientSession()
+        plugins.utils.asyncengine.onShutdown(aclose)
+    headers = {
+        "Content-type": "application/json",
+        "Accept": "application/json",
+        "User-Agent": "Apache Kibble",
+    }
+    if auth:
+        xcreds = auth.encode(encoding='ascii', errors='replace')
+        bauth = base64.encodebytes(xcreds).decode('ascii', errors='replace').replace("\n", '')
+        headers["Authorization"] = "Basic %s" % bauth
+    if token:
+        headers["Authorization"] = "token %s" % token
+    if cookie:
+        headers["Cookie"] = cookie
+    ctimeout = aiohttp.ClientTimeout(total = timeout, connect = CONNECT_TIMEOUT)
+    async with plugins.utils.concurrency.asyncHost(url):
+        async with SESSION.get(url, headers = headers, timeout = ctimeout) as rv:
+            status = rv.status
+            if status < 400:
+                return await rv.json(content_type = None)
+    # Rate limited? Sleep it off, like get() does, without holding a thread.
+    if status == 429 and retries > 0:
+        await asyncio.sleep(60)
+        return await aget(url, cookie = cookie, auth = auth, token = token, retries = retries - 1, timeout = timeout)
+    raise requests.exceptions.ConnectionError("Could not fetch JSON, server responded with status code %u" % status)
+
+async def aclose():
+    """ Closes the shared aiohttp session """
+    global SESSION
+    if SESSION is not None:
+        await SESSION.close()
+        SESSION = None
+
 def gettxt(url, cookie = None, auth = None):
     """ Same as above, but returns as text blob """
     headers = {
@@ -65,7 +117,8 @@ def gettxt(url, cookie = None, auth = None):
         headers["Authorization"] = "Basic %s" % bauth
     if cookie:
         headers["Cookie"] = cookie
-    rv = requests.get(url, headers = headers)
+    with plugins.utils.concurrency.host(url):
+        rv = requests.get(url, headers = headers)
     js = rv.text
     if rv.status_code != 404:
         return js
@@ -83,6 +136,7 @@ def post(url, data, cookie = None, auth = None):
         headers["Authorization"] = "Basic %s" % bauth
     if cookie:
         headers["Cookie"] = cookie
-    rv = requests.post(url, headers = headers, json = data)
+    with plugins.utils.concurrency.host(url):
+        rv = requests.post(url, headers = headers, json = data)
     js = rv.json()
     return js
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble scan planner utility plugin.
+It resolves every source into the concrete list of scanners to run on
+it, applying the command line filters and node balancing up front, so
+the scan workers only ever receive runnable work.
+
+The scanners of a task form a small dependency graph (see the
+`dependencies` list in the scanner plugins): a step becomes runnable
+once every step it depends on has finished, and steps that don't
+depend on each other can be run by different workers at once.
+
+Tasks are handed out longest-processing-time first: the priority of a
+task is its expected scan time (from the durations recorded on earlier
+runs, or failing that, the size of the source), scaled up by how long
+it has been since the source was last scanned successfully. Big and
+out-of-date sources thus start first, instead of whichever happens to
+sort last holding up the end of the run. Sources are handed out an
+organisation at a time (see batches()), so scanning can start while the
+next organisation is still being listed; the order is longest-first
+within each organisation.
+"""
+
+import itertools
+import threading
+import time
+import plugins.scanners
+import plugins.utils.balance
+
+DEFAULT_DURATION = 60 # Expected seconds per scanner when we have no history
+LOC_PER_SECOND = 5000 # Rough scan speed of the git scanners, for sources without history
+STALE_AFTER = 86400 # A source this long out of date gets double priority
+MAX_STALENESS = 30 * 86400 # Never-scanned sources count as this out of date
+DEFAULT_INTERVAL = 86400 # How often the daemon re-scans a source, if nothing is configured
+
+class Task:
+    """ A source, along with the scanners (in run order) to apply to it """
+    def __init__(self, org, source, steps, mine = True, now = None):
+        self.org = org
+        self.source = source
+        self.steps = steps # List of (sid, scanner, extra scan() args)
+        self.mine = mine # False if this belongs to another node and would be stolen
+        self.planned = now or time.time()
+        self.finished = threading.Event() # Set once all steps are done (or skipped)
+        self.priority = priority(source, [sid for sid, scanner, args in steps], now)
+        self.lock = threading.Lock()
+        self.remaining = len(steps)
+        # Only dependencies that are actually part of this task count;
+        # if git-sync is excluded, git-census just runs.
+        sids = set(sid for sid, scanner, args in steps)
+        self.waiting = {}
+        for sid, scanner, args in steps:
+            self.waiting[sid] = set(dep for dep in getattr(scanner, 'dependencies', []) if dep in sids)
+        # The steps that can be run straight away
+        self.roots = [step for step in steps if not self.waiting[step[0]]]
+
+    def finish(self, sid, good = True):
+        """ Marks a step as finished. Returns a tuple of the steps that
+            have become runnable, the steps that will never run because
+            this one (or one of its dependencies) failed, and whether this
+            was the last step of the task. """
+        ready = []
+        skipped = []
+        with self.lock:
+            self.remaining -= 1
+            failed = set() if good else set([sid])
+            for step in self.steps:
+                deps = self.waiting.get(step[0])
+                if deps is None or sid not in deps and not deps & failed:
+                    continue
+                if deps & failed:
+                    failed.add(step[0])
+                    skipped.append(step)
+                    del self.waiting[step[0]]
+                    self.remaining -= 1
+                    continue
+                deps.discard(sid)
+                if not deps:
+                    ready.append(step)
+            del self.waiting[sid]
+            if self.remaining == 0:
+                self.finished.set()
+            return ready, skipped, self.remaining == 0
+
+    def __str__(self):
+        return "%s %s (%s, priority %u): %s%s" % (self.org.id, self.source['sourceURL'], self.source['type'],
+                                     self.priority, ", ".join(sid for sid, scanner, args in self.steps),
+                                     "" if self.mine else " [steal]")
+
+def lastScanned(source):
+    """ When any scanner last completed successfully on a source, or None """
+    last = None
+    for key, step in (source.get('steps') or {}).items():
+        if step.get('good') and 'time' in step and (last is None or step['time'] > last):
+            last = step['time']
+    return last
+
+def duration(source, sids):
+    """ Expected number of seconds it takes to run the given scanners on a source """
+    durations = source.get('durations') or {}
+    expected = 0
+    for sid in sids:
+        if sid in durations:
+            expected += durations[sid]
+        else:
+            expected += DEFAULT_DURATION
+            # Size is our best guess for the git scanners
+            if sid.startswith('git-') and isinstance(source.get('sloc'), dict):
+                expected += source['sloc'].get('loc', 0) / LOC_PER_SECOND
+    return expected
+
+def priority(source, sids, now = None):
+    """ Scheduling priority of a source: expected scan time, scaled by staleness """
+    now = now or time.time()
+    last = lastScanned(source)
+    staleness = min(MAX_STALENESS, now - last) if last else MAX_STALENESS
+    return duration(source, sids) * (1 + max(0, staleness) / STALE_AFTER)
+
+def tooNew(source, minAge):
+    """ Whether any scanner has processed this source since minAge """
+    for key, step in source.get('steps', {}).items():
+        if 'time' in step and step['time'] >= minAge:
+            return True
+    return False
+
+def steps(source, stype = None, exclude = None, jfilter = None):
+    """ Returns the (sid, scanner, args) steps to run on a source, in order """
+    # A jenkins job filter implies we only do jenkins
+    if jfilter:
+        stype = "jenkins"
+    todo = []
+    for sid, scanner in plugins.scanners.enumerate():
+        # Excluded scanner type?
+        if exclude and sid in exclude:
+            continue
+        # Specific scanner type or no types mentioned?
+        if stype and stype != sid:
+            continue
+        if scanner.accepts(source):
+            args = []
+            # specific jenkins filter
+            if jfilter and sid == "jenkins":
+                args = [jfilter]
+            todo.append((sid, scanner, args))
+    return todo
+
+def intervals(config, age = None):
+    """ Returns the re-scan interval (in seconds) per source type, from
+        scanner.intervals. A given --age (in hours) is used as the default. """
+    iv = dict(config['scanner'].get('intervals') or {})
+    if age:
+        iv['default'] = int(age) * 3600
+    iv.setdefault('default', DEFAULT_INTERVAL)
+    return iv
+
+def plan(broker, config, org = None, view = None, age = None, source = None, stype = None, exclude = None, jfilter = None, intervals = None):
+    """ Generates the tasks for this run, one per source that has work.
+        Sources owned by other nodes are only included (with mine = False)
+        when work stealing is enabled. If intervals (per source type) are
+        given, only sources that are due for a re-scan are included. """
+    stealing = plugins.utils.balance.stealing(config)
+    # If --age is passed, only scan sources that either have never
+    # been scanned, or have been scanned more than N hours ago by any scanner.
+    now = time.time()
+    minAge = now - int(age) * 3600 if age else None
+    for korg in broker.organisations():
+        if org and org != korg.id:
+            continue
+        for ksource in korg.sources(view=view):
+            if source and source != ksource['sourceID'] and source != ksource['sourceURL']:
+                continue
+            if minAge and tooNew(ksource, minAge):
+                continue
+            if intervals and tooNew(ksource, now - intervals.get(ksource['type'], intervals['default'])):
+                continue
+            mine = plugins.utils.balance.isMine(ksource['sourceID'], config)
+            if not mine and not stealing:
+                continue
+            todo = steps(ksource, stype, exclude, jfilter)
+            if todo:
+                yield Task(korg, ksource, todo, mine, now)
+
+def batches(tasks):
+    """ Groups planned tasks by organisation, most urgent first. The
+        work queue only orders what it holds, so handing it a whole
+        organisation at once keeps its longest scans from being
+        overtaken by whatever happened to be listed first. """
+    for orgid, group in itertools.groupby(tasks, key = lambda task: task.org.id):
+        yield sorted(group, key = lambda task: task.priority, reverse = True)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble process pool utility plugin.
+It runs CPU-bound scanners in separate worker processes, so they
+don't fight the scan threads over the GIL. Each worker process has
+its own broker (and thus its own database connection) and KibbleBits.
+"""
+
+import concurrent.futures
+import copy
+import multiprocessing
+import multiprocessing.util
+import importlib
+import plugins.utils.concurrency
+
+# Per-process state, set up by init() in each worker
+BROKER = None
+BITS = {}
+
+def init(brokerClass, config):
+    """ Sets up the broker for this worker process """
+    global BROKER
+    plugins.utils.concurrency.configure(config)
+    BROKER = brokerClass(config)
+    # Push whatever is left once the worker process exits
+    multiprocessing.util.Finalize(None, BROKER.close, exitpriority = 10)
+
+def scan(sid, orgClass, orgid, source, tid, *args):
+    """ Runs a single scanner on a source inside a worker process.
+        Returns the (possibly updated) source object. """
+    scanners = importlib.import_module("plugins.scanners")
+    if orgid not in BITS:
+        BITS[orgid] = BROKER.bitClass(BROKER, orgClass(BROKER, orgid), tid)
+    bit = BITS[orgid]
+    bit.tid = tid
+    bit.pluginname = "plugins/scanners/" + sid
+    # So status updates from this process only carry what changed
+    BROKER.trackSource(source)
+    try:
+        scanners.scanners[sid].scan(bit, source, *args)
+    finally:
+        # Don't leave documents behind for when the process dies
+        bit.bulk()
+    return source
+
+class ProcessPool:
+    """ Pool of worker processes for CPU-bound scanners """
+
+    def __init__(self, broker, workers):
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers = workers,
+            mp_context = multiprocessing.get_context('spawn'),
+            initializer = init,
+            initargs = (type(broker), broker.config)
+        )
+
+    def scan(self, sid, bit, source, *args):
+        """ Runs a scanner in a worker process and waits for it. The
+            source object is updated in place with the worker's changes. """
+        org = bit.organisation
+        sent = copy.deepcopy(source)
+        future = self.executor.submit(scan, sid, type(org), org.id, sent, bit.tid, *args)
+        result = future.result()
+        # Other scanners may be working on the same source in the
+        # meantime, so only copy back what this one changed.
+        for key, value in result.items():
+            if key == 'steps' and isinstance(value, dict) and isinstance(source.get('steps'), dict):
+                for step, status in value.items():
+                    if status != sent.get('steps', {}).get(step):
+                        source['steps'][step] = status
+            elif value != sent.get(key):
+                source[key] = value
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+ #the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the Kibble work queue utility plugin.
+It holds pending scan jobs in one priority sub-queue per scanner type
+and group (organisation), so workers can favour one type of work, steal
+from the others once their own sub-queue runs dry, and no single group
+can hog more than its share of the workers. Within a sub-queue, the
+item with the highest priority goes first; equal priorities are FIFO.
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+
+class WorkQueue:
+    """ Thread-safe work queue with per-type sub-queues and work stealing """
+
+    def __init__(self, limit = 0):
+        self.queues = collections.OrderedDict()
+        self.active = collections.Counter()
+        self.limit = limit # Max items handed out per group at once, 0 for no limit
+        self.cond = threading.Condition(threading.Lock())
+        self.closed = False
+        self.size = 0
+        self.types = [] # Types we've had work for, in order of appearance
+        self.counter = itertools.count() # Keeps equal priorities in FIFO order
+
+    def __len__(self):
+        return self.size
+
+    def preferred(self, slot):
+        """ Spreads the types we have seen work for so far across worker
+            slots, so each type gets a worker that favours it """
+        with self.cond:
+            return self.types[slot % len(self.types)] if self.types else None
+
+    def put(self, stype, item, group = None, priority = 0):
+        """ Adds an item to the sub-queue of a given type and group.
+            Once the queue is closed, items are dropped and we return False. """
+        with self.cond:
+            if self.closed:
+                return False
+            key = (stype, group)
+            if stype not in self.types:
+                self.types.append(stype)
+            if key not in self.queues:
+                self.queues[key] = []
+            heapq.heappush(self.queues[key], (-priority, next(self.counter), item))
+            self.size += 1
+            self.cond.notify()
+            return True
+
+    def close(self, discard = False):
+        """ Marks the queue as complete; workers drain it and then get None.
+            With discard, whatever is still pending is thrown away. """
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.queues.clear()
+                self.size = 0
+            self.cond.notify_all()
+
+    def done(self, group = None):
+        """ Tells the queue an item from this group has been dealt with """
+        with self.cond:
+            self.active[group] -= 1
+            self.cond.notify_all()
+
+    def _pick(self, preferred):
+        """ Finds the sub-queue to take work from: our preferred type if
+            possible, otherwise steal. Groups with the least work in
+            progress go first, then the most urgent item, then the
+            longest sub-queue. """
+        best = None
+        bestScore = None
+        for key, q in self.queues.items():
+            stype, group = key
+            if not q or (self.limit and self.active[group] >= self.limit):
+                continue
+            score = (stype != preferred, self.active[group], q[0][0], -len(q))
+            if best is None or score < bestScore:
+                best = key
+                bestScore = score
+        return best
+
+    def get(self, preferred = None):
+        """ Grabs the next (group, item) pair, preferring the given type.
+            Blocks until an item is available, or returns None once the
+            queue is closed and empty. Call done(group) when finished. """
+        with self.cond:
+            while True:
+                if not self.size and self.closed:
+                    return None
+                key = self._pick(preferred) if self.size else None
+                if key:
+                    break
+                self.cond.wait()
+            stype, group = key
+            self.active[group] += 1
+            self.size -= 1
+            item = heapq.heappop(self.queues[key])[2]
+            if not self.queues[key]:
+                del self.queues[key]
+            if not self.size:
+                self.cond.notify_all()
+            return group, item
+
+    def waitEmpty(self):
+        """ Blocks until every queued item has been handed out """
+        with self.cond:
+            while self.size:
+                self.cond.wait()
+
+    def waitIdle(self):
+        """ Blocks until every queued item has been handed out and dealt
+            with. Workers that add follow-up work must do so before
+            calling done(), or the queue may look idle too early. """
+        with self.cond:
+            while self.size or any(self.active.values()):
+                self.cond.wait()